@@ -1,21 +1,345 @@
 import json
-from flask import Flask, request
-from db import db, User, Post, Location, Asset, Allergen
+from flask import Blueprint, Flask, Response, make_response, redirect, request, stream_with_context
+from db import db, User, Post, Location, Asset, Allergen, ALLERGEN_FLAGS
+from db import IMAGE_SIZES, decode_image_data, assoc_table, delete_posts, post_expiry, unexpired
+from db import adjust_post_counts, allergen_mask, allergen_profiles, record_changes
+from db import POST_FULL, POST_SIMP, USER_FULL, USER_SUMMARY
+from db import ASSET_FAILED, ASSET_PENDING
+from indexes import allergen_index, building_board, grid_index
+from cache import cached, response_cache
+from changes import change_feed
+from groupcommit import write_queue
+from ingest import ingestor
+from uploads import UnsupportedImage, UploadTooLarge, receive_image
+from events import event_log
+from sweeper import sweeper
+from sqlalchemy.orm import joinedload, undefer
+from collections import Counter
 import datetime
+import hashlib
+from io import BytesIO
+import os
+import re
+import dataset
+import metrics
+import migrations
+from sqlalchemy.exc import IntegrityError
 
 # DB = db.DatabaseDriver()
 
-app = Flask(__name__)
-db_filename = "free.db"
+api = Blueprint("api", __name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
 
-db.init_app(app)
-with app.app_context():
-    db.drop_all() 
-    db.create_all()
+def create_app(database_file=None, reset_db=None, sync_changes=None):
+    """
+    Application factory. Builds the app against `database_file`, migrating
+    the database and building the in-memory indexes from it.
+
+    Arguments that aren't given come from the environment: DATABASE_FILE,
+    RESET_DB=1 (dev only: wipe the database on startup instead of keeping
+    its data) and SYNC_CHANGES=1 (other processes share the database, see
+    changes.py).
+
+    Background threads aren't started here, so the app can be built before
+    forking worker processes; each process serving it calls `init_worker`.
+    """
+    if database_file is None:
+        database_file = os.environ.get("DATABASE_FILE", "free.db")
+    if reset_db is None:
+        reset_db = os.environ.get("RESET_DB") == "1"
+    if sync_changes is None:
+        sync_changes = os.environ.get("SYNC_CHANGES") == "1"
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % database_file
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # echo logs every statement; use the slow query log in metrics.py instead
+    app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO") == "1"
+    app.config["SYNC_CHANGES"] = sync_changes
+    app.config["GROUP_COMMIT"] = os.environ.get("GROUP_COMMIT") == "1"
+
+    db.init_app(app)
+    ingestor.init_app(app)
+    metrics.init_app(app)
+    write_queue.init_app(app)
+    sweeper.init_app(app, post_deleted)
+    change_feed.init_app(app, apply_changes, rebuild_state)
+    app.register_blueprint(api)
+
+    with app.app_context():
+        if reset_db:
+            migrations.reset(db.engine)
+        migrations.migrate(db.engine)
+        rebuild_state()
+        # forked workers must not inherit open connections
+        db.engine.dispose()
+    return app
+
+
+def init_worker(app):
+    """
+    Prepares the current process to serve `app`: gives it its own database
+    connections, cache and event feed, and starts its background threads.
+    Call once per process, after forking.
+    """
+    with app.app_context():
+        db.engine.dispose()
+    # ETags and event IDs must not be mistaken for another process's
+    response_cache.clear()
+    event_log.reset()
+    sweeper.start()
+    change_feed.start()
+    write_queue.start()
+
+
+def rebuild_state():
+    """
+    Builds the in-memory indexes from the database and drops cached responses
+    """
+    allergen_profiles.load()
+    allergen_index.rebuild()
+    grid_index.rebuild()
+    building_board.rebuild()
+    response_cache.clear()
+    change_feed.mark()
+
+
+# eager loading strategies, so every listing runs a fixed number of queries
+# no matter how many rows it returns
+POST_LOAD = tuple(POST_FULL.options())
+USER_LOAD = tuple(USER_FULL.options())
+# what post_saved reads on top of serializing
+SAVED_LOAD = POST_LOAD + (undefer(Post.expires_at), joinedload(Post.location))
+
+# SQLite caps the number of bound parameters in a single statement
+MAX_IN_PARAMS = 500
+
+# most IDs accepted by one ?ids= multi-get
+MAX_MULTI_GET = MAX_IN_PARAMS
+
+# rows fetched per query when streaming a full listing
+STREAM_BATCH = 500
+
+# most posts accepted by one /api/posts/bulk/ request
+MAX_BULK_POSTS = 500
+
+# defaults and caps for /api/posts/nearby/
+NEARBY_RADIUS_KM = 2.0
+NEARBY_MAX_RADIUS_KM = 50.0
+NEARBY_K = 20
+NEARBY_MAX_K = 100
+
+# posts embedded in /api/users/<id>/, and page sizes for /api/users/<id>/posts/
+USER_RECENT_POSTS = 10
+USER_POSTS_LIMIT = 20
+USER_POSTS_MAX_LIMIT = 100
+
+# page sizes for /api/posts/search/
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# bm25 weights of the description, building and room search columns
+SEARCH_WEIGHTS = (1.0, 2.0, 0.5)
+
+
+def posts_by_ids(ids, *options):
+    """
+    Fetches the unexpired posts whose IDs are in `ids` in ascending ID order,
+    with one IN query per `MAX_IN_PARAMS` IDs
+    """
+    posts = []
+    for start in range(0, len(ids), MAX_IN_PARAMS):
+        chunk = ids[start:start + MAX_IN_PARAMS]
+        posts.extend(
+            Post.query.options(*options)
+            .filter(Post.id.in_(chunk), unexpired()).order_by(Post.id)
+        )
+    return posts
+
+
+def keyset_batches(model, options, after=None, limit=None, batch=STREAM_BATCH, criteria=()):
+    """
+    Yields lists of `model` rows matching `criteria` in ascending ID order, 
+    starting after the ID cursor `after` and stopping after `limit` rows if
+    given. Each batch is one query, so only `batch` rows are held at a time.
+    """
+    while limit is None or limit > 0:
+        size = batch if limit is None else min(batch, limit)
+        query = model.query.options(*options).filter(*criteria).order_by(model.id)
+        if after is not None:
+            query = query.filter(model.id > after)
+        rows = query.limit(size).all()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = rows[-1].id
+        if limit is not None:
+            limit -= len(rows)
+
+
+def filter_flags():
+    """
+    Returns the valid dietary flags in the comma separated `filter` query parameter
+    """
+    args = request.args.get("filter", "").split(",")
+    return [arg.strip() for arg in args if arg.strip() in ALLERGEN_FLAGS]
+
+
+def page_args():
+    """
+    Parses the `limit` and `after` cursor query parameters, using None for
+    any that are missing. Raises ValueError if either is not a valid integer.
+    """
+    limit, after = (
+        None if request.args.get(name) is None else int(request.args[name])
+        for name in ("limit", "after")
+    )
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be positive")
+    return limit, after
+
+
+def fieldset(serializer):
+    """
+    Returns the serialize function and loader options for the comma separated
+    `fields` query parameter, or for every field of `serializer` if it is 
+    missing. Raises ValueError for unknown fields.
+    """
+    fields = request.args.get("fields")
+    if fields is None:
+        return serializer, serializer.options()
+    return serializer.only(f.strip() for f in fields.split(",") if f.strip())
+
+
+def list_page(key, model, serializer, criteria=()):
+    """
+    Responds with a listing of the `model` rows matching `criteria` under 
+    `key`, serialized with `serializer` restricted to the `fields` query
+    parameter.
+
+    With `?stream=1` the JSON array is streamed one batch at a time. With
+    `?limit=` only that many rows after the `?after=` cursor are returned,
+    along with a `next` cursor that is null on the last page. With 
+    `?ids=1,2,3` only those rows are returned, see `multi_get`.
+    """
+    try:
+        limit, after = page_args()
+        serialize, options = fieldset(serializer)
+    except ValueError:
+        return resp_err("Bad request", 400)
+
+    if request.args.get("ids") is not None:
+        return multi_get(key, model, serialize, options, criteria)
+
+    if request.args.get("stream") in ("1", "true"):
+        batches = keyset_batches(model, options, after, limit, criteria=criteria)
+        return resp_stream(key, ([serialize(r) for r in b] for b in batches))
+
+    rows = []
+    for batch in keyset_batches(model, options, after, limit, criteria=criteria):
+        rows.extend(batch)
+    with metrics.serializing():
+        body = {key: [serialize(r) for r in rows]}
+    if limit is not None:
+        body["next"] = rows[-1].id if len(rows) == limit else None
+    return resp_succ(body)
+
+
+def multi_get(key, model, serialize, options, criteria=()):
+    """
+    Responds with the `model` rows matching `criteria` whose IDs are in the
+    comma separated `ids` query parameter, fetched with one IN query, as an
+    object under `key` keyed by ID, along with the list of `missing` IDs
+    """
+    try:
+        ids = [int(i) for i in request.args["ids"].split(",") if i.strip()]
+    except ValueError:
+        return resp_err("Bad request", 400)
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAX_MULTI_GET:
+        return resp_err("Bad request", 400)
+
+    rows = model.query.options(*options).filter(model.id.in_(ids), *criteria)
+    with metrics.serializing():
+        found = {row.id: serialize(row) for row in rows}
+    return resp_succ({
+        key: {str(i): found[i] for i in ids if i in found},
+        "missing": [i for i in ids if i not in found],
+    })
+
+
+def post_saved(post, created=False):
+    """
+    Brings the in-memory indexes and response cache up to date with `post`
+    after a commit that created or changed it, and publishes the change to
+    the event feed
+    """
+    allergens = post.allergens[0].serialize_simp() if post.allergens else {}
+    allergen_index.add(post.id, allergens)
+    building_board.add(post.id, post.building, allergens, post.expires_at)
+    if post.location is not None:
+        grid_index.add(post.id, post.location.latitude, post.location.longitude, post.expires_at)
+    else:
+        grid_index.remove(post.id)
+    response_cache.bump("posts", "post:%d" % post.id, "user:%d" % post.user_id)
+    event_log.publish("created" if created else "updated", post.serialize())
+
+
+def post_deleted(post_id, user_id):
+    """
+    Drops the post with an id of `post_id` from the in-memory indexes and
+    response cache after a commit that deleted it, and publishes the 
+    deletion to the event feed
+    """
+    allergen_index.remove(post_id)
+    building_board.remove(post_id)
+    grid_index.remove(post_id)
+    response_cache.bump("posts", "post:%d" % post_id, "user:%d" % user_id)
+    event_log.publish("deleted", {"id": post_id, "user_id": user_id})
+
+
+def commit_write(write):
+    """
+    Runs `write()`, which stages changes in `db.session`, and commits them,
+    together with other requests' writes if group commit is on (see 
+    groupcommit.py). Returns the result of `write()`.
+    """
+    if write_queue.running():
+        return write_queue.submit(write)
+    result = write()
+    db.session.commit()
+    return result
+
+
+def saved_post(post_id):
+    """
+    Loads the post with an id of `post_id` as post_saved and serializing need
+    it, after a write committed it
+    """
+    query = Post.query.options(*SAVED_LOAD)
+    # the request may have loaded the post before another thread committed it
+    return query.populate_existing().get(post_id)
+
+
+def apply_changes(changes):
+    """
+    Brings the in-memory indexes, response cache and event feed up to date
+    with `changes` committed by other processes
+    """
+    saved = {}
+    for change in changes:
+        if change.kind == "user":
+            response_cache.bump("userlist", "users", "user:%d" % change.user_id)
+        elif change.kind == "deleted":
+            saved.pop(change.post_id, None)
+            post_deleted(change.post_id, change.user_id)
+        else:
+            saved[change.post_id] = saved.get(change.post_id) or change.kind == "created"
+
+    posts = posts_by_ids(sorted(saved), *SAVED_LOAD)
+    for post in posts:
+        post_saved(post, created=saved[post.id])
 
 
 # generalized response formats
@@ -23,7 +347,8 @@ def resp_succ(body, code=200):
     """
     Returns a JSON representation of `body`, with a default success `code` of 200.
     """
-    return json.dumps(body), code
+    with metrics.serializing():
+        return json.dumps(body), code
 
 
 def resp_err(message, code=404):
@@ -32,53 +357,149 @@ def resp_err(message, code=404):
     """
     return json.dumps({"error": message}), code
 
+
+def resp_stream(key, batches):
+    """
+    Streams `{key: [...]}` as JSON, encoding each list in `batches` only once
+    the previous one has been sent.
+    """
+    def generate():
+        yield '{"%s": [' % key
+        first = True
+        for batch in batches:
+            if batch:
+                chunk = ", ".join(json.dumps(item) for item in batch)
+                yield chunk if first else ", " + chunk
+                first = False
+        yield "]}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
 #actual routes
-@app.route("/api/posts/")
+@api.route("/api/_metrics")
+def get_metrics():
+    """
+    Per-route request metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@api.route("/api/posts/")
+@cached("posts", "users")
 def get_posts():
     """
-    Get all posts
+    Get all posts, optionally paginated with `limit`/`after`, streamed, or
+    limited to the `fields` query parameter
     """
-    posts = []
-    for post in Post.query.all():
-         posts.append(post.serialize())
-    return resp_succ({"posts": posts})
+    return list_page("posts", Post, POST_FULL, [unexpired()])
 
 
-@app.route("/api/posts/<int:post_id>/")
+@api.route("/api/posts/<int:post_id>/")
+@cached("post:{post_id}", "users")
 def get_post(post_id):
     """
-    Get the post with an id of `post_id`
+    Get the post with an id of `post_id`, limited to the `fields` query parameter if given
     """
-    post = Post.query.filter_by(id=post_id).first()
+    try:
+        serialize, _ = fieldset(POST_FULL)
+    except ValueError:
+        return resp_err("Bad request", 400)
+
+    # the ETag covers every field, so load them all
+    post = Post.query.options(*POST_LOAD).filter(Post.id == post_id, unexpired()).first()
     if post is None:
         return resp_err("Invalid ID", 404)
-    return resp_succ(post.serialize()) 
+    with metrics.serializing():
+        body, code = resp_succ(serialize(post))
+    return body, code, {"ETag": post_etag(post)}
+
+
+def recent_posts(user_id, serialize, options, limit, before=None):
+    """
+    Returns the user's unexpired posts, newest first, at most `limit` of
+    them and only those with IDs below the cursor `before` if given, along
+    with the cursor of the next page (None on the last page)
+    """
+    query = Post.query.options(*options).filter(Post.user_id == user_id, unexpired())
+    if before is not None:
+        query = query.filter(Post.id < before)
+    posts = query.order_by(Post.id.desc()).limit(limit + 1).all()
+    more = len(posts) > limit
+    posts = posts[:limit]
+    with metrics.serializing():
+        return [serialize(p) for p in posts], posts[-1].id if more else None
 
 
-@app.route("/api/users/<int:user_id>/")
+@api.route("/api/users/<int:user_id>/")
+@cached("user:{user_id}", "users")
 def get_user(user_id):
     """
-    Get a user with an ID of `user_id`
+    Get a user with an ID of `user_id`, with their `post_count` and their 
+    USER_RECENT_POSTS most recent posts, limited to the `fields` query
+    parameter if given. `next` is the `before` cursor for 
+    /api/users/<id>/posts/, or null if there are no older posts.
     """
-    user = User.query.filter_by(id=user_id).first()
+    fields = request.args.get("fields")
+    names = None if fields is None else [f.strip() for f in fields.split(",") if f.strip()]
+    with_posts = names is None or "posts" in names
+    try:
+        if names is None:
+            serialize, options = USER_SUMMARY, USER_SUMMARY.options()
+        else:
+            serialize, options = USER_SUMMARY.only(n for n in names if n != "posts")
+    except ValueError:
+        return resp_err("Bad request", 400)
+
+    user = User.query.options(*options).filter_by(id=user_id).first()
     if user is None:
         return resp_err("User not found", 404)
 
-    return resp_succ(user.serialize()) 
+    with metrics.serializing():
+        body = serialize(user)
+    if with_posts:
+        body["posts"], body["next"] = recent_posts(
+            user_id, POST_SIMP, POST_SIMP.options(), USER_RECENT_POSTS
+        )
+    return resp_succ(body)
 
 
-@app.route("/api/users/")
+@api.route("/api/users/<int:user_id>/posts/")
+@cached("user:{user_id}", "users")
+def get_user_posts(user_id):
+    """
+    Get the posts of the user with an ID of `user_id`, newest first, `limit`
+    at a time before the `before` cursor, limited to the `fields` query
+    parameter if given. `next` is the cursor of the next page, or null on
+    the last page.
+    """
+    try:
+        limit = min(int(request.args.get("limit", USER_POSTS_LIMIT)), USER_POSTS_MAX_LIMIT)
+        before = request.args.get("before")
+        before = None if before is None else int(before)
+        serialize, options = fieldset(POST_SIMP)
+    except ValueError:
+        return resp_err("Bad request", 400)
+    if limit < 1:
+        return resp_err("Bad request", 400)
+
+    if db.session.query(User.id).filter_by(id=user_id).first() is None:
+        return resp_err("User not found", 404)
+
+    posts, next_cursor = recent_posts(user_id, serialize, options, limit, before)
+    return resp_succ({"posts": posts, "next": next_cursor})
+
+
+@api.route("/api/users/")
+@cached("posts", "users", "userlist")
 def get_users():
     """
-    Get all users
+    Get all users, optionally paginated with `limit`/`after`, streamed, or
+    limited to the `fields` query parameter
     """
-    users = []
-    for user in User.query.all():
-         users.append(user.serialize())
-    return resp_succ({"posts": users})
+    return list_page("posts", User, USER_FULL)
 
 
-@app.route("/api/posts/", methods=["POST"])
+@api.route("/api/posts/", methods=["POST"])
 def make_post():
     """
     Make a post with specifications in the request body.
@@ -108,10 +529,16 @@ def make_post():
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return resp_err("User does not exist", 404)
-    
-    new_post = Post(user_id=user_id, building=building, room=room, description=description) 
-    db.session.add(new_post)
 
+    location_id = body.get("location_id")
+    if location_id is not None and Location.query.get(location_id) is None:
+        return resp_err("Location does not exist", 404)
+
+    try:
+        expires_at = post_expiry(body.get("ttl"))
+    except ValueError as e:
+        return resp_err(str(e), 400)
+    
     allergens_dict = {
         "vegan": vegan, 
         "vegetarian": vegetarian, 
@@ -123,57 +550,494 @@ def make_post():
         "wheat_free": wheat_free,
         "soy_free": soy_free
     }
-    new_allergens = Allergen(**allergens_dict)
-    db.session.add(new_allergens)
-    new_post.allergens.append(new_allergens) 
-    
-    user.posts.append(new_post)
+    allergen_id = allergen_profiles.id_for(allergens_dict)
 
-    db.session.commit()
+    def write():
+        new_post = Post(user_id=user_id, building=building, room=room, 
+        description=description, location_id=location_id, expires_at=expires_at) 
+        db.session.add(new_post)
+        adjust_post_counts({user_id: 1})
+        db.session.flush()
+
+        db.session.execute(assoc_table.insert(), {"post_id": new_post.id, "allergen_id": allergen_id})
+        record_changes("created", [(new_post.id, user_id)])
+        return new_post.id
+
+    new_post = saved_post(commit_write(write))
+    post_saved(new_post, created=True)
 
     return resp_succ(new_post.serialize(), 201)
 
-@app.route("/api/posts/filter/")
+
+def is_id(value):
+    """
+    Returns whether `value` from a JSON body can be a row ID
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    """
+    Returns whether `value` from a JSON body is a number
+    """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def existing_ids(model, ids):
+    """
+    Returns the subset of `ids` that are IDs of `model` rows
+    """
+    ids = list(set(ids))
+    found = set()
+    for start in range(0, len(ids), MAX_IN_PARAMS):
+        chunk = ids[start:start + MAX_IN_PARAMS]
+        found.update(i for (i,) in db.session.query(model.id).filter(model.id.in_(chunk)))
+    return found
+
+
+def insert_many(table, rows):
+    """
+    Inserts `rows` into `table` with one executemany and returns their new 
+    IDs in order. Must run inside the write transaction that commits them:
+    while it holds SQLite's write lock nothing else can insert, and each new
+    rowid is one past the largest, so the rows get the last len(rows) IDs.
+    """
+    db.session.execute(table.insert(), rows)
+    last = db.session.execute(db.select([db.func.max(table.c.id)])).scalar()
+    return list(range(last - len(rows) + 1, last + 1))
+
+
+@api.route("/api/posts/bulk/", methods=["POST"])
+def make_posts():
+    """
+    Make many posts at once from a JSON array in the request body, where each
+    item has the same fields as for POST /api/posts/.
+
+    Valid items are inserted in a single transaction. Invalid items are 
+    skipped and reported under `errors` by their index in the array.
+    """
+    items = json.loads(request.data)
+    if not isinstance(items, list) or len(items) > MAX_BULK_POSTS:
+        return resp_err("Bad request", 400)
+
+    required = ["user_id", "building", "room", "description"] + ALLERGEN_FLAGS
+    errors = []
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or None in [item.get(f) for f in required]:
+            errors.append({"index": i, "error": "Bad request"})
+            continue
+        location_id = item.get("location_id")
+        if not is_id(item["user_id"]) or (location_id is not None and not is_id(location_id)):
+            errors.append({"index": i, "error": "Bad request"})
+            continue
+        try:
+            item["expires_at"] = post_expiry(item.get("ttl"))
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+            continue
+        valid.append((i, item))
+
+    users = existing_ids(User, [item["user_id"] for _, item in valid])
+    locations = existing_ids(Location, [
+        item["location_id"] for _, item in valid if item.get("location_id") is not None
+    ])
+    accepted = []
+    for i, item in valid:
+        if item["user_id"] not in users:
+            errors.append({"index": i, "error": "User does not exist"})
+        elif item.get("location_id") is not None and item["location_id"] not in locations:
+            errors.append({"index": i, "error": "Location does not exist"})
+        else:
+            accepted.append(item)
+
+    created = []
+    if accepted:
+        post_ids = insert_many(Post.__table__, [{
+            "user_id": item["user_id"],
+            "building": item["building"],
+            "room": item["room"],
+            "description": item["description"],
+            "location_id": item.get("location_id"),
+            "expires_at": item["expires_at"],
+        } for item in accepted])
+        db.session.execute(assoc_table.insert(), [
+            {"post_id": p, "allergen_id": allergen_profiles.id_for(item)}
+            for p, item in zip(post_ids, accepted)
+        ])
+        adjust_post_counts(Counter(item["user_id"] for item in accepted))
+        record_changes("created", zip(post_ids, [item["user_id"] for item in accepted]))
+        db.session.commit()
+
+        for post in posts_by_ids(post_ids, *SAVED_LOAD):
+            post_saved(post, created=True)
+            created.append(post.serialize())
+
+    errors.sort(key=lambda e: e["index"])
+    return resp_succ({"posts": created, "errors": errors}, 201 if created else 400)
+
+
+@api.route("/api/posts/filter/")
+@cached("posts")
 def filter_posts():
     """
     Endpoint for filtering posts based on query parameters.
 
-    Returns a JSON of all locations that pass the specified filter.
+    Returns a JSON of all posts that pass the specified filter, as a single
+    list ordered by post ID.
 
     Query parameter is specified by the 'filter' key and a comma 
     separated string of values. 
     For example, .../filter?filter='dairy_free'
     """
-    args = request.args.to_dict()["filter"].split(",")
-
-    temp = {}
-    valid_args = [
-        "vegan",
-        "vegetarian",
-        "gluten_free",
-        "dairy_free",
-        "nut_free",
-        "fish_free",
-        "shell_free", 
-        "wheat_free",
-        "soy_free",
-    ]
-
-    for arg in args:
-        arg = arg.strip()
-        if arg in valid_args and arg is not "location":
-            temp[arg] = True
-    
-    allergens = Allergen.query.filter_by(**temp)
+    try:
+        serialize, options = fieldset(POST_SIMP)
+    except ValueError:
+        return resp_err("Bad request", 400)
 
-    posts = []
-    for allergen in allergens:
-        posts.append([p.serialize_simp() for p in allergen.posts])
+    post_ids = allergen_index.match(filter_flags())
+    with metrics.serializing():
+        posts = [serialize(p) for p in posts_by_ids(post_ids, *options)]
 
     return resp_succ({"posts": posts})
 
 
-@app.route("/api/users/", methods=["POST"])
+def search_post_ids(q, flags, limit, offset):
+    """
+    Returns the IDs of the unexpired posts matching every word in `q` (each
+    also as a prefix) and carrying every dietary flag in `flags`, best match
+    first, in a single query
+    """
+    words = re.findall(r"\w+", q)
+    if not words:
+        return []
+    match = " ".join('"%s"*' % word for word in words)
+
+    # expired posts are left out before the page is cut, so it isn't short
+    joins = "JOIN posts ON posts.id = posts_fts.rowid "
+    conditions = ["posts_fts MATCH :match", "posts.expires_at > :now"]
+    if flags:
+        joins += (
+            "JOIN association ON association.post_id = posts_fts.rowid "
+            "JOIN allergens ON allergens.id = association.allergen_id "
+        )
+        conditions += ["allergens.%s = 1" % flag for flag in flags]
+    sql = (
+        "SELECT posts_fts.rowid FROM posts_fts " + joins +
+        "WHERE " + " AND ".join(conditions) +
+        " ORDER BY bm25(posts_fts, %r, %r, %r), posts_fts.rowid" % SEARCH_WEIGHTS +
+        " LIMIT :limit OFFSET :offset"
+    )
+    query = db.text(sql).bindparams(db.bindparam("now", type_=db.DateTime))
+    rows = db.session.execute(query, {
+        "match": match, "now": datetime.datetime.now(), "limit": limit, "offset": offset,
+    })
+    return [post_id for (post_id,) in rows]
+
+
+@api.route("/api/posts/search/")
+@cached("posts", "users")
+def search_posts():
+    """
+    Full-text search over post descriptions, buildings and rooms.
+
+    Returns the posts matching the words in `q`, best match first, a page of
+    `limit` at a time starting at `offset`, along with the `next` offset
+    (null on the last page). Accepts the same `filter` query parameter as
+    /api/posts/filter/, and `fields`.
+    For example, .../search/?q=pizza&filter=vegan
+    """
+    try:
+        q = request.args["q"]
+        limit = min(int(request.args.get("limit", SEARCH_LIMIT)), SEARCH_MAX_LIMIT)
+        offset = int(request.args.get("offset", 0))
+        serialize, options = fieldset(POST_FULL)
+    except (KeyError, ValueError):
+        return resp_err("Bad request", 400)
+    if limit < 1 or offset < 0:
+        return resp_err("Bad request", 400)
+
+    # one extra row tells whether there is another page
+    post_ids = search_post_ids(q, filter_flags(), limit + 1, offset)
+    more = len(post_ids) > limit
+    post_ids = post_ids[:limit]
+
+    posts = {p.id: p for p in posts_by_ids(sorted(post_ids), *options)}
+    with metrics.serializing():
+        results = [serialize(posts[i]) for i in post_ids if i in posts]
+    return resp_succ({"posts": results, "next": offset + limit if more else None})
+
+
+@api.route("/api/posts/stream/")
+def stream_posts():
+    """
+    Server-sent events feed of post changes, so clients don't have to poll.
+
+    Sends a "created" or "updated" event with the post, or a "deleted" event
+    with its id, for every change. A client reconnecting with the 
+    Last-Event-ID header (or `last_event_id` query parameter) is sent the 
+    events it missed, or a "reset" event if they are no longer available.
+    Responds 503 when the process already has MAX_SUBSCRIBERS subscribers.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    subscription = event_log.subscribe(last_event_id)
+    if subscription is None:
+        return resp_err("Too many subscribers", 503)
+    response = Response(subscription, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@api.route("/api/posts/nearby/")
+@cached("posts", "users")
+def nearby_posts():
+    """
+    Endpoint for finding the posts closest to the user.
+
+    Returns up to `k` posts whose location is within `radius` km (at most
+    NEARBY_MAX_RADIUS_KM) of `lat`/`lng`, nearest first, each with its 
+    `distance` in km. Accepts the same `filter` query parameter as 
+    /api/posts/filter/, and `fields`.
+    For example, .../nearby/?lat=42.45&lng=-76.48&radius=1&filter=vegan
+    """
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        radius = float(request.args.get("radius", NEARBY_RADIUS_KM))
+        k = int(request.args.get("k", NEARBY_K))
+        serialize, options = fieldset(POST_FULL)
+    except (KeyError, ValueError):
+        return resp_err("Bad request", 400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 0 < radius <= NEARBY_MAX_RADIUS_KM) or k < 1:
+        return resp_err("Bad request", 400)
+    k = min(k, NEARBY_MAX_K)
+
+    accept = None
+    flags = filter_flags()
+    if flags:
+        bits = allergen_index.bits(flags)
+        accept = lambda post_id: bits >> post_id & 1
+
+    found = grid_index.nearest(lat, lng, radius, k, accept)
+    posts = {p.id: p for p in posts_by_ids(sorted(p for _, p in found), *options)}
+
+    nearby = []
+    with metrics.serializing():
+        for distance, post_id in found:
+            if post_id in posts:
+                post = serialize(posts[post_id])
+                post["distance"] = round(distance, 3)
+                nearby.append(post)
+    return resp_succ({"posts": nearby})
+
+
+@api.route("/api/buildings/summary/")
+def get_building_summary():
+    """
+    Get, for every building with posts, how many posts it has and how many of
+    them carry each dietary flag, from counts kept up to date as posts change.
+    Not cached, since posts drop off the board as they expire.
+    """
+    return resp_succ({"buildings": building_board.summary()})
+
+
+@api.route("/api/export/")
+def export_data():
+    """
+    Stream the users, locations, allergen profiles and posts as NDJSON, one
+    {"table": ..., "row": {...}} per line (see dataset.py), gzipped if the
+    client accepts gzip. To resume an interrupted export, pass the table and
+    ID of the last line received as `cursor`, e.g. ?cursor=posts:1234
+    """
+    try:
+        cursor = dataset.parse_cursor(request.args.get("cursor"))
+    except ValueError:
+        return resp_err("Bad request", 400)
+
+    chunks = dataset.export_lines(cursor)
+    gzip = request.accept_encodings["gzip"] > 0
+    if gzip:
+        chunks = dataset.gzipped(chunks)
+    response = Response(stream_with_context(chunks), mimetype="application/x-ndjson")
+    if gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@api.route("/api/locations/")
+def get_locations():
+    """
+    Get all locations
+    """
+    return resp_succ({"locations": [l.serialize() for l in Location.query.all()]})
+
+
+@api.route("/api/locations/", methods=["POST"])
+def make_location():
+    """
+    Make a new location with a name, latitude and longitude specified in the request body
+    """
+    body = json.loads(request.data)
+
+    name = body.get("name")
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
+    if None in [name, latitude, longitude]:
+        return resp_err("Bad request", 400)
+    if not (is_number(latitude) and is_number(longitude)):
+        return resp_err("Bad request", 400)
+    # NaN fails both comparisons too
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return resp_err("Bad request", 400)
+
+    new_location = Location(name=name, latitude=latitude, longitude=longitude)
+    db.session.add(new_location)
+    db.session.commit()
+
+    return resp_succ(new_location.serialize(), 201)
+
+
+@api.route("/api/images/", methods=["POST"])
+def upload_image():
+    """
+    Upload an image given as a base64 data URI under `image_data` in the 
+    request body. 
+    
+    An image whose bytes were uploaded before returns the existing asset 
+    with 200. Otherwise the sizes are rendered and stored in the background,
+    so the new asset is returned as "pending" with 202; poll 
+    /api/images/<id>/ for its URLs.
+    """
+    body = json.loads(request.data)
+
+    image_data = body.get("image_data")
+    if image_data is None:
+        return resp_err("Bad request", 400)
+
+    try:
+        ext, img_data = decode_image_data(image_data)
+    except ValueError as e:
+        return resp_err(str(e), 400)
+    content_hash = hashlib.sha256(img_data).hexdigest()
+    return ingest_image(content_hash, ext, BytesIO(img_data))
+
+
+@api.route("/api/images/upload/", methods=["POST"])
+def upload_image_stream():
+    """
+    Upload an image of up to MAX_IMAGE_BYTES, sent either as the raw request
+    body (e.g. with Content-Type: image/png) or as the `image` file of a 
+    multipart form. The body is streamed to a spool rather than buffered.
+
+    Responds like POST /api/images/, except that the width and height are
+    known while the asset is still pending.
+    """
+    try:
+        spool = receive_image(request)
+    except UploadTooLarge:
+        return resp_err("Image too large", 413)
+    except ValueError:
+        return resp_err("Bad request", 400)
+
+    try:
+        ext, size = spool.sniff()
+    except UnsupportedImage as e:
+        spool.close()
+        return resp_err(str(e), 415)
+    return ingest_image(spool.content_hash(), ext, spool, size)
+
+
+def ingest_image(content_hash, ext, image, size=None):
+    """
+    Responds with the asset for the image whose SHA-256 is `content_hash`:
+    the existing one with 200, or a new pending one with 202 once the file
+    object `image` is queued for processing, as is an existing one whose
+    processing failed. Takes ownership of `image`.
+    """
+    asset = Asset.query.filter_by(content_hash=content_hash).first()
+    if asset is not None and asset.status == ASSET_FAILED:
+        return retry_image(asset, ext, image, size)
+    if asset is not None:
+        image.close()
+        return resp_succ(asset.serialize())
+
+    asset = Asset(content_hash=content_hash, extension=ext)
+    if size is not None:
+        asset.width, asset.height = size
+    db.session.add(asset)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # the same image was uploaded concurrently
+        db.session.rollback()
+        image.close()
+        asset = Asset.query.filter_by(content_hash=content_hash).first()
+        return resp_succ(asset.serialize())
+
+    if not ingestor.submit(asset.id, image):
+        image.close()
+        db.session.delete(asset)
+        db.session.commit()
+        return resp_err("Too many uploads in progress", 503)
+
+    return resp_succ(asset.serialize(), 202)
+
+
+def retry_image(asset, ext, image, size=None):
+    """
+    Processes `image` again for `asset`, whose processing failed, unless
+    another upload of the same image already retried it. Responds like 
+    `ingest_image`.
+    """
+    assets = Asset.__table__
+    values = {"status": ASSET_PENDING, "extension": ext}
+    if size is not None:
+        values["width"], values["height"] = size
+    # only one concurrent upload gets to flip it back to pending
+    claimed = db.session.execute(
+        assets.update().where(db.and_(assets.c.id == asset.id, assets.c.status == ASSET_FAILED))
+        .values(**values)
+    ).rowcount
+    db.session.commit()
+    db.session.refresh(asset)
+    if not claimed:
+        image.close()
+        return resp_succ(asset.serialize())
+
+    if not ingestor.submit(asset.id, image):
+        image.close()
+        asset.status = ASSET_FAILED
+        db.session.commit()
+        return resp_err("Too many uploads in progress", 503)
+
+    return resp_succ(asset.serialize(), 202)
+
+
+@api.route("/api/images/<int:asset_id>/")
+def get_image(asset_id):
+    """
+    Get the asset with an id of `asset_id`, including its processing status.
+
+    With a `size` query parameter (one of IMAGE_SIZES) redirects to that 
+    size of the image instead. For example, .../images/1/?size=thumb
+    """
+    asset = Asset.query.filter_by(id=asset_id).first()
+    if asset is None:
+        return resp_err("Image not found", 404)
+
+    size = request.args.get("size")
+    if size is None:
+        return resp_succ(asset.serialize())
+    if size not in IMAGE_SIZES:
+        return resp_err("Bad request", 400)
+    if asset.url(size) is None:
+        return resp_err("Image not ready", 404)
+    return redirect(asset.url(size))
+
+
+@api.route("/api/users/", methods=["POST"])
 def make_user():
     """
     Make a new user with a name specified in the request body
@@ -185,13 +1049,19 @@ def make_user():
     if name is None:
         return resp_err("Bad request", 400)
 
-    new_user = User(name=name)
-    db.session.add(new_user)
-    db.session.commit()
+    def write():
+        new_user = User(name=name)
+        db.session.add(new_user)
+        db.session.flush()
+        record_changes("user", [(None, new_user.id)])
+        return new_user.id
+
+    new_user = User.query.get(commit_write(write))
+    response_cache.bump("userlist")
 
     return resp_succ(new_user.serialize(), 201)
 
-@app.route("/api/posts/<int:post_id>/", methods=["POST"])
+@api.route("/api/posts/<int:post_id>/", methods=["POST"])
 def update_post(post_id):
     """
     Update a specific posts allergens.
@@ -221,13 +1091,11 @@ def update_post(post_id):
     post = Post.query.filter_by(id=post_id).first()
     if post is None:
         return resp_err("Invalid Post ID", 404)
-    post.building = building 
-    post.room = description
-    post.description = description
 
-    db.session.delete(post.allergens[0]) #delete old allergens
-    
-    #construct new Allergen(), commit it, and append it to post 
+    location_id = body.get("location_id", post.location_id)
+    if location_id is not None and Location.query.get(location_id) is None:
+        return resp_err("Location does not exist", 404)
+
     allergens_dict = {
         "vegan": vegan, 
         "vegetarian": vegetarian, 
@@ -239,15 +1107,135 @@ def update_post(post_id):
         "wheat_free": wheat_free,
         "soy_free": soy_free
     }
-    new_allergens = Allergen(**allergens_dict)
-    db.session.add(new_allergens)
-    post.allergens.append(new_allergens)
-    
-    db.session.commit() 
+    fields = {"building": building, "room": room, "description": description, "location_id": location_id}
+    return save_post_changes(post_id, fields, allergens_dict)
+
 
-    return resp_succ(post.serialize(), 200)
+@api.route("/api/posts/<int:post_id>/", methods=["PATCH"])
+def patch_post(post_id):
+    """
+    Update only the fields of the post with an id of `post_id` that the
+    request body gives: any of building, room, description, location_id,
+    ttl (minutes from now until it expires) and the allergen flags.
 
-@app.route("/api/users/<int:user_id>/", methods=["POST"])
+    Responds with the post and its ETag. With an If-Match header, the post
+    is only updated if it still has one of the given ETags, and 412 is 
+    returned otherwise.
+    """
+    body = json.loads(request.data)
+    if not isinstance(body, dict):
+        return resp_err("Bad request", 400)
+
+    fields = {field: body[field] for field in PATCH_POST_FIELDS if field in body}
+    flags = {flag: body[flag] for flag in ALLERGEN_FLAGS if flag in body}
+    if None in flags.values() or None in [fields.get(f, "") for f in ["building", "room", "description"]]:
+        return resp_err("Bad request", 400)
+
+    location_id = fields.get("location_id")
+    if location_id is not None and Location.query.get(location_id) is None:
+        return resp_err("Location does not exist", 404)
+
+    if "ttl" in body:
+        try:
+            fields["expires_at"] = post_expiry(body["ttl"])
+        except ValueError as e:
+            return resp_err(str(e), 400)
+
+    return save_post_changes(post_id, fields, flags, request.if_match)
+
+
+# fields of a post that PATCH /api/posts/<id>/ can change, besides ttl and 
+# the allergen flags
+PATCH_POST_FIELDS = ["building", "room", "description", "location_id"]
+
+
+def post_etag(post):
+    """
+    Strong ETag of the post's full representation, which is the same in
+    every process. GET /api/posts/<id>/ sends it for any `fields`, since
+    it changes whenever any part of the post does.
+    """
+    return hashlib.sha1(json.dumps(POST_FULL(post), sort_keys=True).encode()).hexdigest()
+
+
+def post_changes(post, fields, flags):
+    """
+    Returns the columns in the dict `fields` whose values differ from 
+    `post`'s, and the ID of the allergen profile the flags in `flags` move 
+    it to, or None if they don't change its allergens
+    """
+    columns = {
+        field: value for field, value in fields.items()
+        # a new expiry time is always a change
+        if field == "expires_at" or getattr(post, field) != value
+    }
+    current = post.allergens[0].serialize_simp() if post.allergens else {}
+    merged = dict(current, **flags)
+    if post.allergens and allergen_mask(merged) == allergen_mask(current):
+        return columns, None
+    return columns, allergen_profiles.id_for(merged)
+
+
+def save_post_changes(post_id, fields, flags, if_match=None):
+    """
+    Writes the changes to `fields` and the allergen `flags` of the post with
+    an id of `post_id`, if `if_match` (an ETags set, empty for no 
+    precondition) contains its ETag. Skips the write when nothing differs.
+    Responds with the post and its ETag.
+    """
+    def load():
+        return Post.query.options(*POST_LOAD).filter(Post.id == post_id, unexpired())
+
+    post = load().first()
+    if post is None:
+        return resp_err("Invalid Post ID", 404)
+    if if_match and not if_match.contains(post_etag(post)):
+        return resp_err("Post has changed", 412)
+
+    columns, allergen_id = post_changes(post, fields, flags)
+    if columns or allergen_id is not None:
+        def write():
+            # a write first, so the transaction holds SQLite's write lock and
+            # no one else can change the post between the check and the
+            # update, then check again against the row as it now is
+            db.session.execute(
+                Post.__table__.update().where(Post.__table__.c.id == post_id)
+                .values(id=Post.__table__.c.id)
+            )
+            post = load().populate_existing().first()
+            if post is None:
+                return None
+            if if_match and not if_match.contains(post_etag(post)):
+                return False
+            columns, allergen_id = post_changes(post, fields, flags)
+            for field, value in columns.items():
+                setattr(post, field, value)
+            if allergen_id is not None:
+                if post.allergens:
+                    db.session.execute(
+                        assoc_table.update().where(assoc_table.c.post_id == post_id), 
+                        {"allergen_id": allergen_id}
+                    )
+                else:
+                    db.session.execute(assoc_table.insert(), {"post_id": post_id, "allergen_id": allergen_id})
+            if columns or allergen_id is not None:
+                record_changes("updated", [(post.id, post.user_id)])
+            return True
+
+        written = commit_write(write)
+        if written is None:
+            return resp_err("Invalid Post ID", 404)
+        if not written:
+            return resp_err("Post has changed", 412)
+        post = saved_post(post_id)
+        post_saved(post)
+
+    response = make_response(resp_succ(post.serialize()))
+    response.set_etag(post_etag(post))
+    return response
+
+
+@api.route("/api/users/<int:user_id>/", methods=["POST"])
 def update_user(user_id):
     """
     Updates the fields for the user with an id if `user_id`
@@ -262,12 +1250,16 @@ def update_user(user_id):
     if name is None:
         return resp_err("Bad request", 400)
 
-    user.name = name 
+    def write():
+        User.query.filter_by(id=user_id).update({User.name: name})
+        record_changes("user", [(None, user_id)])
 
-    db.session.commit()
+    commit_write(write)
+    db.session.refresh(user)
+    response_cache.bump("users", "user:%d" % user_id)
     return resp_succ(user.serialize()) 
      
-@app.route("/api/posts/<int:post_id>/", methods=["DELETE"])
+@api.route("/api/posts/<int:post_id>/", methods=["DELETE"])
 def del_post(post_id):
     """
     Delete the post whose ID is `post_id`
@@ -277,32 +1269,56 @@ def del_post(post_id):
         return resp_err("Post not found", 404)
 
     temp = post.serialize()
-    db.session.delete(post)
-    db.session.commit()
+    deleted, _ = commit_write(lambda: delete_posts([post_id]))
+    if not deleted:
+        return resp_err("Post not found", 404)
+    post_deleted(post_id, temp["user_id"])
     return resp_succ(temp)  
 
-@app.route("/api/closed/", methods=["DELETE"])
+@api.route("/api/closed/", methods=["DELETE"])
 def close_location():
     """
-    Endpoint for whenever a building closes. All food at the specified location is deleted. 
+    Endpoint for whenever a building closes. All food in the `building` or at
+    the location named `location` (or with id `location_id`) given in the 
+    request body is deleted, in one transaction.
 
-    NOTE: LOCATIONS NOT TESTED/IMPLEMENTED
+    Returns how many posts and association rows were deleted.
     """
     body = json.loads(request.data)
 
+    building = body.get("building")
     location_name = body.get("location")
-    if location_name is None:
+    location_id = body.get("location_id")
+    if building is None and location_name is None and location_id is None:
         return resp_err("Bad request", 400)
 
-    location = Location.query.filter_by(name=location_name)
-    temp = location.posts.serialize()
-    db.session.delete(location.posts)
+    criteria = []
+    if building is not None:
+        criteria.append(Post.building == building)
+    if location_name is not None:
+        criteria.append(Post.location_id.in_(
+            db.session.query(Location.id).filter(Location.name == location_name)
+        ))
+    if location_id is not None:
+        criteria.append(Post.location_id == location_id)
+
+    closed = [post_id for (post_id,) in db.session.query(Post.id).filter(db.or_(*criteria))]
+    deleted, associations = [], 0
+    for start in range(0, len(closed), MAX_IN_PARAMS):
+        posts, count = delete_posts(closed[start:start + MAX_IN_PARAMS])
+        deleted.extend(posts)
+        associations += count
     db.session.commit()
-    return resp_succ(temp)
+
+    for post_id, user_id in deleted:
+        post_deleted(post_id, user_id)
+    return resp_succ({"deleted": {"posts": len(deleted), "associations": associations}})
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app = create_app()
+    init_worker(app)
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
 
 ###################################################################################
 # OLD FUNCTIONS
@@ -0,0 +1,330 @@
+"""
+Traffic replay benchmark.
+
+Seeds a scratch database with users, locations and posts carrying a given
+number of distinct sets of dietary flags (allergen profiles), replays a
+request mix against the app in-process through Flask's test client, and
+reports throughput and p50/p95/p99 latency per route. Results can be saved
+as a JSON baseline and later runs compared against it to flag regressions.
+
+    python bench.py --posts 5000 --requests 20000 --concurrency 8 --save base.json
+    python bench.py --posts 5000 --requests 20000 --concurrency 8 --compare base.json
+
+The request mix is synthetic unless --mix points to a JSON-lines file of
+recorded requests, one {"method": ..., "path": ..., "body": ...} per line.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# rough weights of each kind of request in the synthetic mix
+SYNTHETIC_MIX = [
+    ("list", 30),
+    ("page", 10),
+    ("post", 20),
+    ("filter", 15),
+    ("nearby", 10),
+    ("search", 5),
+    ("user", 5),
+    ("create", 6),
+    ("update", 4),
+]
+
+CAMPUS = (42.447, -76.483)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--locations", type=int, default=50)
+    parser.add_argument("--profiles", type=int, default=32,
+                        help="distinct sets of dietary flags the posts carry")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mix", help="JSON-lines file of recorded requests to replay")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="database file to seed (default: a temp file)")
+    parser.add_argument("--save", help="write the results to this JSON baseline")
+    parser.add_argument("--compare", help="compare the results with this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed fractional slowdown before flagging a regression")
+    return parser.parse_args(argv)
+
+
+def load_app(db_file):
+    """
+    Builds the app against a fresh `db_file`. Returns the app module and app.
+    """
+    import app as app_module
+    app = app_module.create_app(os.path.abspath(db_file), reset_db=True)
+    app_module.init_worker(app)
+    return app_module, app
+
+
+def flag_profiles(rng, count):
+    """
+    Returns `count` distinct dicts of dietary flags drawn at random, or every
+    possible one if there are fewer than `count`
+    """
+    from db import ALLERGEN_FLAGS
+
+    masks = rng.sample(range(2 ** len(ALLERGEN_FLAGS)), min(count, 2 ** len(ALLERGEN_FLAGS)))
+    return [
+        {flag: bool(mask >> i & 1) for i, flag in enumerate(ALLERGEN_FLAGS)}
+        for mask in masks
+    ]
+
+
+def seed(app_module, app, rng, users, locations, posts, profiles=None):
+    """
+    Fills the database with `users` users, inserted in one statement since 
+    the app has no endpoint to make many at once, and with `locations` 
+    locations and `posts` posts made through the app's own endpoints. Each
+    post carries one of the `profiles` flag dicts, 32 random ones if not 
+    given.
+    """
+    from db import db, User
+
+    if profiles is None:
+        profiles = flag_profiles(rng, 32)
+
+    client = app.test_client()
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {"name": "user%d" % i} for i in range(users)
+        ])
+        db.session.commit()
+
+    for i in range(locations):
+        client.post("/api/locations/", data=json.dumps({
+            "name": "Building %d" % i,
+            "latitude": CAMPUS[0] + rng.uniform(-0.02, 0.02),
+            "longitude": CAMPUS[1] + rng.uniform(-0.02, 0.02),
+        }))
+
+    batch = []
+    for i in range(posts):
+        item = {
+            "user_id": rng.randint(1, users),
+            "building": "Building %d" % rng.randrange(locations),
+            "room": str(rng.randint(100, 499)),
+            "description": "free food %d" % i,
+            "location_id": rng.randint(1, locations),
+        }
+        item.update(rng.choice(profiles))
+        batch.append(item)
+        if len(batch) == app_module.MAX_BULK_POSTS or i == posts - 1:
+            response = client.post("/api/posts/bulk/", data=json.dumps(batch))
+            if response.status_code != 201:
+                raise RuntimeError("seeding failed: %s" % response.data[:200])
+            batch = []
+
+
+def synthetic_requests(rng, count, users, posts, profiles):
+    """
+    Yields `count` (method, path, body) requests drawn from SYNTHETIC_MIX,
+    with the writes carrying one of the `profiles` flag dicts
+    """
+    from db import ALLERGEN_FLAGS
+
+    kinds = [kind for kind, _ in SYNTHETIC_MIX]
+    weights = [weight for _, weight in SYNTHETIC_MIX]
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "list":
+            yield "GET", "/api/posts/", None
+        elif kind == "page":
+            yield "GET", "/api/posts/?limit=50&after=%d" % rng.randrange(posts), None
+        elif kind == "post":
+            yield "GET", "/api/posts/%d/" % rng.randint(1, posts), None
+        elif kind == "filter":
+            flags = rng.sample(ALLERGEN_FLAGS, rng.randint(1, 3))
+            yield "GET", "/api/posts/filter/?filter=%s" % ",".join(flags), None
+        elif kind == "nearby":
+            yield "GET", "/api/posts/nearby/?lat=%f&lng=%f&radius=1&k=20" % (
+                CAMPUS[0] + rng.uniform(-0.01, 0.01), CAMPUS[1] + rng.uniform(-0.01, 0.01)
+            ), None
+        elif kind == "search":
+            yield "GET", "/api/posts/search/?q=food+%d" % rng.randrange(posts), None
+        elif kind == "user":
+            yield "GET", "/api/users/%d/" % rng.randint(1, users), None
+        else:
+            body = {
+                "user_id": rng.randint(1, users),
+                "building": "Building 0",
+                "room": "101",
+                "description": "bench",
+            }
+            body.update(rng.choice(profiles))
+            if kind == "create":
+                yield "POST", "/api/posts/", body
+            else:
+                yield "POST", "/api/posts/%d/" % rng.randint(1, posts), body
+
+
+def recorded_requests(path):
+    """
+    Yields the (method, path, body) requests recorded in the JSON-lines file `path`
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry.get("method", "GET").upper(), entry["path"], entry.get("body")
+
+
+def percentile(ordered, pct):
+    """
+    Nearest-rank percentile of the already sorted list `ordered`
+    """
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def replay(app, requests, concurrency):
+    """
+    Sends `requests` with `concurrency` threads, each with its own test
+    client, and returns (route -> [latency seconds], route -> error count,
+    wall time)
+    """
+    adapter = app.url_map.bind("localhost")
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    requests = iter(requests)
+    local = threading.local()
+
+    def route_of(method, path):
+        try:
+            endpoint, _ = adapter.match(path.split("?")[0], method)
+        except Exception:
+            endpoint = "unmatched"
+        return "%s %s" % (method, endpoint)
+
+    def worker():
+        local.client = app.test_client()
+        while True:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                return
+            method, path, body = request
+            data = json.dumps(body) if body is not None else None
+
+            start = time.perf_counter()
+            response = local.client.open(path, method=method, data=data)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+
+            route = route_of(method, path)
+            with lock:
+                latencies.setdefault(route, []).append(elapsed)
+                if response.status_code >= 500:
+                    errors[route] = errors.get(route, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarize(latencies, errors, wall):
+    routes = {}
+    for route, samples in sorted(latencies.items()):
+        ordered = sorted(samples)
+        routes[route] = {
+            "count": len(ordered),
+            "errors": errors.get(route, 0),
+            "rps": len(ordered) / wall,
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p95_ms": percentile(ordered, 95) * 1000,
+            "p99_ms": percentile(ordered, 99) * 1000,
+        }
+    total = sum(len(samples) for samples in latencies.values())
+    return {"requests": total, "seconds": wall, "rps": total / wall, "routes": routes}
+
+
+def report(results):
+    print("%-34s %7s %6s %9s %9s %9s %9s" % (
+        "route", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for route, stats in results["routes"].items():
+        print("%-34s %7d %6d %9.1f %9.2f %9.2f %9.2f" % (
+            route, stats["count"], stats["errors"], stats["rps"],
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+    print("total: %d requests in %.2fs, %.1f req/s" % (
+        results["requests"], results["seconds"], results["rps"]))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a description of every route that got slower or less
+    throughput than `baseline` by more than `tolerance`
+    """
+    regressions = []
+    for route, base in baseline["routes"].items():
+        stats = results["routes"].get(route)
+        if stats is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if stats[key] > base[key] * (1 + tolerance):
+                regressions.append("%s %s %.2f -> %.2f" % (route, key, base[key], stats[key]))
+        if stats["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append("%s req/s %.1f -> %.1f" % (route, base["rps"], stats["rps"]))
+    if results["rps"] < baseline["rps"] * (1 - tolerance):
+        regressions.append("total req/s %.1f -> %.1f" % (baseline["rps"], results["rps"]))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    db_file = args.db
+    if db_file is None:
+        handle, db_file = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+    app_module, app = load_app(db_file)
+    profiles = flag_profiles(rng, args.profiles)
+    seed(app_module, app, rng, args.users, args.locations, args.posts, profiles)
+
+    if args.mix:
+        requests = recorded_requests(args.mix)
+    else:
+        requests = synthetic_requests(rng, args.requests, args.users, args.posts, profiles)
+    latencies, errors, wall = replay(app, requests, args.concurrency)
+
+    results = summarize(latencies, errors, wall)
+    results["config"] = {
+        key: getattr(args, key)
+        for key in ("users", "posts", "locations", "profiles", "requests", "concurrency", "mix", "seed")
+    }
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+    if args.db is None:
+        os.remove(db_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
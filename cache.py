@@ -0,0 +1,129 @@
+"""
+Response cache for GET endpoints.
+
+Each cached view depends on a few named scopes (e.g. "posts" or "post:3"),
+and every scope has a version counter that the write handlers bump after a
+commit. A cached response is only served while the versions it was rendered
+at are still current, so a write invalidates just the entries that depend on
+what it touched. ETags are derived from those versions, which lets an
+unchanged resource answer 304 without rendering or touching the database,
+unless a view supplies its own, which is cached with its body.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+
+
+class ResponseCache:
+    """
+    Bounded LRU map from request key to rendered body, tagged with the scope
+    versions the body was rendered at
+    """
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        # versions restart at zero with the process, so tag ETags with it
+        self.epoch = uuid.uuid4().hex
+
+    def current(self, scopes):
+        """
+        Returns the current versions of `scopes`
+        """
+        with self.lock:
+            return tuple(self.versions.get(scope, 0) for scope in scopes)
+
+    def bump(self, *scopes):
+        """
+        Invalidates every entry that depends on any of `scopes`
+        """
+        with self.lock:
+            for scope in scopes:
+                self.versions[scope] = self.versions.get(scope, 0) + 1
+
+    def etag(self, key, versions):
+        raw = "%s|%r|%r" % (self.epoch, key, versions)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key, versions):
+        """
+        Returns the (body, ETag) cached under `key` if it was rendered at
+        `versions`
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != versions:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, versions, entry):
+        with self.lock:
+            self.entries[key] = (versions, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.versions.clear()
+            self.epoch = uuid.uuid4().hex
+
+
+response_cache = ResponseCache()
+
+
+def cached(*scopes):
+    """
+    Caches successful responses of the decorated GET view, keyed by path and
+    query arguments. `scopes` may refer to the view's URL arguments, e.g.
+    "post:{post_id}".
+
+    The ETag is derived from the scope versions, unless the view returns
+    one of its own as (body, 200, {"ETag": tag}), which is cached with the
+    body.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            deps = tuple(scope.format(**kwargs) for scope in scopes)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            versions = response_cache.current(deps)
+            etag = response_cache.etag(key, versions)
+
+            if request.if_none_match.contains(etag):
+                return not_modified(etag)
+
+            entry = response_cache.get(key, versions)
+            if entry is None:
+                result = view(**kwargs)
+                if not isinstance(result, tuple) or result[1] != 200:
+                    return result
+                if len(result) > 2:
+                    etag = result[2]["ETag"]
+                entry = (result[0], etag)
+                response_cache.put(key, versions, entry)
+
+            body, etag = entry
+            if request.if_none_match.contains(etag):
+                return not_modified(etag)
+            response = make_response(body, 200)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,117 @@
+"""
+Coherence of in-memory state across worker processes.
+
+Every worker process has its own allergen and grid indexes, response cache
+and event feed, which its write handlers update after each commit. When
+several processes share the database (SYNC_CHANGES, turned on by
+gunicorn.conf.py when it runs more than one worker), the write handlers
+also append each post and user change to the `changes` table in the
+transaction that makes it. Every worker applies the changes other processes
+made before handling a request, so reads see every committed write, and
+every SYNC_INTERVAL seconds in the background, so event-stream subscribers
+hear about them too.
+
+The log is trimmed to its last CHANGE_LOG_SIZE rows. A worker that falls
+further behind than that rebuilds its indexes and clears its cache instead.
+"""
+import os
+import threading
+
+from db import db, change_table
+
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", 1))
+CHANGE_LOG_SIZE = int(os.environ.get("CHANGE_LOG_SIZE", 10000))
+
+
+class ChangeFeed:
+    """
+    Applies the changes other processes recorded with `db.record_changes`,
+    in commit order
+    """
+    def __init__(self, interval=SYNC_INTERVAL, keep=CHANGE_LOG_SIZE):
+        self.app = None
+        self.apply = None
+        self.rebuild = None
+        self.interval = interval
+        self.keep = keep
+        self.last = 0
+        self.lock = threading.RLock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def init_app(self, app, apply, rebuild):
+        """
+        Has `app` apply other processes' changes before each request with
+        `apply(rows)`, where each row has a kind, post_id and user_id, or
+        with `rebuild()` when the log no longer has them all
+        """
+        self.app = app
+        self.apply = apply
+        self.rebuild = rebuild
+        if app.config.get("SYNC_CHANGES"):
+            app.before_request(self.catch_up)
+
+    def mark(self):
+        """
+        Records that the in-memory state reflects every change logged so far.
+        Call after building it from the database.
+        """
+        with self.lock:
+            self.last = db.session.execute(
+                db.select([db.func.coalesce(db.func.max(change_table.c.id), 0)])
+            ).scalar()
+
+    def catch_up(self):
+        """
+        Applies the changes logged by other processes since the last call
+        """
+        with self.lock:
+            rows = db.session.execute(
+                change_table.select().where(change_table.c.id > self.last)
+                .order_by(change_table.c.id)
+            ).fetchall()
+            if not rows:
+                return
+
+            if rows[0].id > self.last + 1:
+                # the changes in between were trimmed before we saw them
+                self.rebuild()
+            else:
+                pid = os.getpid()
+                self.apply([row for row in rows if row.pid != pid])
+
+            previous, self.last = self.last, rows[-1].id
+            if self.last // self.keep > previous // self.keep:
+                self.trim()
+
+    def trim(self):
+        db.session.execute(change_table.delete().where(change_table.c.id <= self.last - self.keep))
+        db.session.commit()
+
+    def start(self):
+        """
+        Starts applying changes in the background, if SYNC_CHANGES is on
+        """
+        if not self.app.config.get("SYNC_CHANGES") or self.interval <= 0:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="changes", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.catch_up()
+            except Exception as e:
+                print(f"Error when applying changes: {e}")
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,266 @@
+"""
+NDJSON export and import of the dataset.
+
+The users, locations, allergen profiles and posts are written one row per
+line as {"table": ..., "row": {...}}, a table at a time in that order and
+each in ID order, so every row's references come before it. Each table is
+read with keyset pagination, EXPORT_BATCH rows per query, so an export of
+any size runs in constant memory and never holds a read transaction open
+for long. A post's row carries the ID of its allergen profile as
+`allergen_id`. The export isn't a snapshot: rows written while it runs may
+or may not be in it.
+
+An interrupted export resumes from a cursor made of the table and ID of the
+last line received, e.g. "posts:1234".
+
+An import reads the lines in IMPORT_BATCH-row transactions. SQLite doesn't
+enforce foreign keys here (the app never turns them on), so references
+aren't checked row by row: they are checked once at the end, and rows whose
+references don't resolve are counted rather than rejected. Rows whose ID
+already exists are skipped, so an interrupted import can simply be run
+again.
+Allergen profiles are matched to the target's by their flags rather than
+inserted, and every user's post count is recomputed at the end. Workers
+that are already running don't see imported rows until they restart.
+
+    python dataset.py export --gzip -o posts.ndjson.gz
+    python dataset.py export --cursor posts:1234 >> posts.ndjson
+    python dataset.py import posts.ndjson.gz
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sys
+import zlib
+
+from flask import Flask
+
+import migrations
+from db import db, User, Location, Allergen, Post, assoc_table, allergen_mask
+
+EXPORT_BATCH = 1000
+IMPORT_BATCH = 5000
+
+EXPORT_TABLES = [User.__table__, Location.__table__, Allergen.__table__, Post.__table__]
+TABLES = {table.name: table for table in EXPORT_TABLES}
+
+
+def parse_cursor(cursor):
+    """
+    Returns the (table name, ID) of the export cursor `cursor`, or None if
+    it is None. Raises ValueError if it is not a valid cursor.
+    """
+    if cursor is None:
+        return None
+    name, _, row_id = cursor.partition(":")
+    if name not in TABLES:
+        raise ValueError("Unknown table")
+    return name, int(row_id)
+
+
+def export_query(table):
+    if table is not Post.__table__:
+        return db.select([table])
+    allergen_id = db.select([assoc_table.c.allergen_id]) \
+        .where(assoc_table.c.post_id == table.c.id).limit(1).as_scalar()
+    return db.select([table, allergen_id.label("allergen_id")])
+
+
+def json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def export_batches(cursor=None, batch=EXPORT_BATCH):
+    """
+    Yields lists of the {"table": ..., "row": ...} records of the dataset,
+    in export order, starting after the position `cursor` if given
+    """
+    start, after = cursor or (EXPORT_TABLES[0].name, None)
+    names = [table.name for table in EXPORT_TABLES]
+    for table in EXPORT_TABLES[names.index(start):]:
+        while True:
+            query = export_query(table).order_by(table.c.id).limit(batch)
+            if after is not None:
+                query = query.where(table.c.id > after)
+            rows = db.session.execute(query).fetchall()
+            if rows:
+                yield [{
+                    "table": table.name,
+                    "row": {key: json_value(value) for key, value in row.items()},
+                } for row in rows]
+            if len(rows) < batch:
+                break
+            after = rows[-1].id
+        after = None
+
+
+def export_lines(cursor=None):
+    """
+    Yields the export as NDJSON text, one chunk per batch of rows
+    """
+    for records in export_batches(cursor):
+        yield "".join(json.dumps(record) + "\n" for record in records)
+
+
+def gzipped(chunks):
+    """
+    Compresses the text `chunks` into a gzip stream as they come
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def import_row(table, row):
+    """
+    Returns the exported `row` of `table` as insert parameters
+    """
+    params = {}
+    for column in table.columns:
+        value = row.get(column.name)
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.datetime.fromisoformat(value)
+        params[column.name] = value
+    return params
+
+
+def flush(table, rows, profiles, summary):
+    """
+    Inserts the exported `rows` of `table` in one transaction, skipping
+    those whose ID exists, along with the association rows of posts, whose
+    exported allergen IDs map to the target's in `profiles`. Adds how many
+    rows were inserted to `summary`.
+    """
+    if not rows:
+        return
+    result = db.session.execute(
+        table.insert().prefix_with("OR IGNORE"), [import_row(table, row) for row in rows]
+    )
+    summary[table.name] = summary.get(table.name, 0) + result.rowcount
+
+    if table is Post.__table__:
+        # a post skipped by an earlier, interrupted run already has its row
+        db.session.execute(
+            "INSERT INTO association (post_id, allergen_id) SELECT :post_id, :allergen_id "
+            "WHERE :allergen_id IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM association WHERE post_id = :post_id)",
+            [{
+                "post_id": row["id"], 
+                "allergen_id": profiles.get(row.get("allergen_id"), row.get("allergen_id")),
+            } for row in rows]
+        )
+    db.session.commit()
+
+
+def import_lines(lines, batch=IMPORT_BATCH):
+    """
+    Imports the NDJSON `lines` of an export. Returns how many rows of each
+    table were inserted, and under "dangling" how many rows in the database
+    have references that don't resolve, as found by one foreign key check
+    at the end.
+    """
+    # the target's own profile for every set of flags
+    by_mask = dict(db.session.query(Allergen.mask, Allergen.id).filter(Allergen.mask.isnot(None)))
+    profiles = {}
+    summary = {}
+    table, rows = None, []
+
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        row = record["row"]
+        if record["table"] == "allergens":
+            mask = row.get("mask")
+            profiles[row["id"]] = by_mask[allergen_mask(row) if mask is None else mask]
+            continue
+
+        if TABLES[record["table"]] is not table or len(rows) >= batch:
+            flush(table, rows, profiles, summary)
+            table, rows = TABLES[record["table"]], []
+        rows.append(row)
+    flush(table, rows, profiles, summary)
+
+    # counts exported mid-write, or of users whose posts were skipped, may
+    # be off
+    db.session.execute(
+        "UPDATE users SET post_count = "
+        "(SELECT count(*) FROM posts WHERE posts.user_id = users.id)"
+    )
+    db.session.commit()
+
+    summary["dangling"] = len(db.session.execute("PRAGMA foreign_key_check").fetchall())
+    return summary
+
+
+def cli_app(database_file):
+    """
+    Builds a bare app against `database_file`, migrated but without the
+    in-memory state the web app loads, which grows with the dataset
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % database_file
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        migrations.migrate(db.engine)
+    return app
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default=os.environ.get("DATABASE_FILE", "free.db"))
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    export = commands.add_parser("export", help="write the dataset as NDJSON")
+    export.add_argument("-o", "--output", help="file to write (default: stdout)")
+    export.add_argument("--cursor", help="resume after this table:id position")
+    export.add_argument("--gzip", action="store_true", help="gzip the output")
+
+    load = commands.add_parser("import", help="load an NDJSON export")
+    load.add_argument("input", help="file to read, gzipped or not, or - for stdin")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = cli_app(args.db)
+
+    with app.app_context():
+        if args.command == "export":
+            chunks = export_lines(parse_cursor(args.cursor))
+            if args.gzip:
+                chunks = gzipped(chunks)
+            else:
+                chunks = (chunk.encode() for chunk in chunks)
+            out = open(args.output, "wb") if args.output else sys.stdout.buffer
+            try:
+                for chunk in chunks:
+                    out.write(chunk)
+            finally:
+                if args.output:
+                    out.close()
+            return 0
+
+        if args.input == "-":
+            summary = import_lines(line.decode() for line in sys.stdin.buffer)
+        else:
+            with open(args.input, "rb") as f:
+                gzipped_input = f.read(2) == b"\x1f\x8b"
+            opener = gzip.open if gzipped_input else open
+            with opener(args.input, "rt") as f:
+                summary = import_lines(f)
+        print(json.dumps(summary))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,33 +2,88 @@ import code
 from http.client import NETWORK_AUTHENTICATION_REQUIRED
 from turtle import title
 from unicodedata import name
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
+from engine import TunedSQLAlchemy
+from metrics import serializer
+from serializers import Serializer
 from sqlalchemy import ForeignKey
 import base64
-import boto3
+import binascii
+from collections import Counter
 import datetime
 import io
 from io import BytesIO
 from mimetypes import guess_extension, guess_type
 import os
 from PIL import Image
-import random
 import re
-import string
+import threading
 
-db = SQLAlchemy()
+db = TunedSQLAlchemy()
 
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
+
+# Asset.status values
+ASSET_PENDING = "pending"
+ASSET_READY = "ready"
+ASSET_FAILED = "failed"
+
+# derivative sizes stored for every image, by longest side in pixels
+IMAGE_SIZES = {
+    "thumb": 160,
+    "list": 640,
+    "full": None,
+}
+
+# how long a post stays up unless it is given its own ttl, in minutes
+POST_TTL_MINUTES = int(os.environ.get("POST_TTL_MINUTES", 120))
+MAX_POST_TTL_MINUTES = 7 * 24 * 60
+
+# dietary flags stored on each Allergen row
+ALLERGEN_FLAGS = [
+    "vegan",
+    "vegetarian",
+    "gluten_free",
+    "dairy_free",
+    "nut_free",
+    "fish_free",
+    "shell_free",
+    "wheat_free",
+    "soy_free",
+]
 
 assoc_table = db.Table(
     "association",
-    db.Column("post_id", db.Integer, db.ForeignKey("posts.id")),
-    db.Column("allergen_id", db.Integer, db.ForeignKey("allergens.id"))
+    db.Column("post_id", db.Integer, db.ForeignKey("posts.id"), index=True),
+    db.Column("allergen_id", db.Integer, db.ForeignKey("allergens.id"), index=True)
+)
+
+# post and user changes committed by each process, so the other worker 
+# processes can apply them to their in-memory state (see changes.py)
+change_table = db.Table(
+    "changes",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("kind", db.String, nullable=False),
+    db.Column("post_id", db.Integer),
+    db.Column("user_id", db.Integer),
+    db.Column("pid", db.Integer, nullable=False)
 )
 
+
+def record_changes(kind, rows):
+    """
+    Appends a `kind` change ("created", "updated" or "deleted" for posts, 
+    "user" for users) for each (post_id, user_id) pair in `rows` to the 
+    change log, if SYNC_CHANGES is on. Doesn't commit.
+    """
+    rows = list(rows)
+    if rows and current_app.config.get("SYNC_CHANGES"):
+        pid = os.getpid()
+        db.session.execute(change_table.insert(), [
+            {"kind": kind, "post_id": post_id, "user_id": user_id, "pid": pid}
+            for post_id, user_id in rows
+        ])
+
 class User(db.Model):
     """
     User Model
@@ -38,33 +93,43 @@ class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     name = db.Column(db.String, nullable=False)
+    # kept up to date by the write handlers in the transaction that adds or 
+    # deletes posts, see adjust_post_counts
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     posts = db.relationship("Post", back_populates="user", cascade="delete")
+    # the user's unexpired posts, as of each time they are loaded, so a 
+    # selectinload of them is one IN query that leaves out expired ones
+    live_posts = db.relationship(
+        "Post",
+        primaryjoin=lambda: db.and_(
+            User.id == Post.user_id,
+            Post.expires_at > db.bindparam("now", callable_=datetime.datetime.now, type_=db.DateTime),
+        ),
+        order_by=lambda: Post.id,
+        viewonly=True,
+    )
 
     def __init__(self, **kwargs):
         """
         initialize user object
         """
         self.name = kwargs.get("name", "anonymous")
+        self.post_count = 0
 
+    @serializer
     def serialize(self):
         """
         Serialize user object along with any posts user has made
-        """ 
-        return {
-            "id" : self.id,
-            "name" : self.name,
-            "posts": [p.serialize_simp() for p in self.posts]
-        }
+        """
+        return USER_FULL(self)
     
+    @serializer
     def serialize_simp(self):
         """
         Serialize user w/o posts 
         """
-        return {
-            "id" : self.id,
-            "name" : self.name
-        }
+        return USER_SIMP(self)
 
 class Post(db.Model):
     """
@@ -76,21 +141,23 @@ class Post(db.Model):
     __tablename__ = "posts"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     user = db.relationship("User", back_populates="posts")
 
     allergens = db.relationship("Allergen", secondary=assoc_table, back_populates="posts")
 
-    building = db.Column(db.String, nullable=False)
+    building = db.Column(db.String, nullable=False, index=True)
     # latitude = db.Column(db.Integer, db.ForeignKey("locations.latitude"), nullable = False)
     # longitude = db.Column(db.Integer, db.ForeignKey("locations.longitude"), nullable = False)
-    # location_id = db.Column(db.Integer, db.ForeignKey("locations.id"))
-    # location = db.relationship("Location", back_populates="posts")
+    location_id = db.Column(db.Integer, db.ForeignKey("locations.id"), index=True)
+    location = db.relationship("Location", back_populates="posts")
 
     # img_url = db.Column(db.String, db.ForeignKey("assets.id"), nullable = False)
     room = db.Column(db.String)
     description = db.Column(db.String)
     image_URL = db.Column(db.String)
+    # expired posts are hidden from reads and deleted by the sweeper
+    expires_at = db.Column(db.DateTime, index=True)
 
     def __init__(self, **kwargs):
         """
@@ -98,10 +165,12 @@ class Post(db.Model):
         """
         self.user_id = kwargs.get("user_id")
         self.building = kwargs.get("building", "")
+        self.location_id = kwargs.get("location_id")
         # self.latitude = kwargs.get("latitude")
         # self.longitude = kwargs.get("longitude")
         self.room = kwargs.get("room", "")
         self.description = kwargs.get("description", "")
+        self.expires_at = kwargs.get("expires_at") or post_expiry()
         # self.image_URL = kwargs.get("url")
         # self.image_URL = kwargs.get("image_URL", "")
         # self.vegan = kwargs.get("vegan", "")
@@ -109,51 +178,85 @@ class Post(db.Model):
         # self.gluten_free = kwargs.get("gluten_free", "")
         # self.allergens = kwargs.get("allergens", "")
 
+    @serializer
     def serialize(self):
         """
         Serialize Post object
         """
-        return {
-            "id" :self.id,
-            "user_id" : self.user_id,
-            "user": self.user.serialize_simp(),
-            "building" : self.building,
-            "room" : self.room,
-            "descrption": self.description,
-            "allergens": [a.serialize_simp() for a in self.allergens]
-            # "latitude" : self.latitude,
-            # "longitude" : self.longitude,
-            # "description" : self.description,
-            # "image_URL" : self.image_URL,
-            # "vegan" : self.vegan,
-            # "vegetarian" : self.vegetarian,
-            # "gluten_free" : self.gluten_free,
-            # "dairy_free" : self.dairy_free,
-            # "nut_free" : self.nut_free,
-            # "allergens" : self.allergens
-        }
+        return POST_FULL(self)
     
+    @serializer
     def serialize_simp(self):
         """
         Serialize Post object
         """
-        return {
-            "id" :self.id,
-            "user_id" : self.user_id,
-            "building" : self.building,
-            "room" : self.room,
-            "allergens": [a.serialize_simp() for a in self.allergens]
-            # "latitude" : self.latitude,
-            # "longitude" : self.longitude,
-            # "description" : self.description,
-            # "image_URL" : self.image_URL,
-            # "vegan" : self.vegan,
-            # "vegetarian" : self.vegetarian,
-            # "gluten_free" : self.gluten_free,
-            # "dairy_free" : self.dairy_free,
-            # "nut_free" : self.nut_free,
-            # "allergens" : self.allergens
-        }
+        return POST_SIMP(self)
+
+def post_expiry(ttl=None):
+    """
+    Returns when a post created now should expire, `ttl` minutes from now or
+    POST_TTL_MINUTES if not given. Raises ValueError if `ttl` is not a 
+    positive number of minutes up to MAX_POST_TTL_MINUTES.
+    """
+    if ttl is None:
+        ttl = POST_TTL_MINUTES
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)):
+        raise ValueError("ttl must be a number of minutes")
+    if not 0 < ttl <= MAX_POST_TTL_MINUTES:
+        raise ValueError("ttl out of range")
+    return datetime.datetime.now() + datetime.timedelta(minutes=ttl)
+
+
+def unexpired():
+    """
+    Query criterion for posts that have not expired yet
+    """
+    return Post.expires_at > datetime.datetime.now()
+
+
+def adjust_post_counts(deltas):
+    """
+    Adds to each user's post_count the delta for their ID in the dict 
+    `deltas`, with one executemany. Doesn't commit.
+    """
+    rows = [{"user": user_id, "delta": delta} for user_id, delta in deltas.items() if delta]
+    if rows:
+        users = User.__table__
+        db.session.execute(
+            users.update().where(users.c.id == db.bindparam("user"))
+            .values(post_count=users.c.post_count + db.bindparam("delta")),
+            rows
+        )
+
+
+def delete_posts(post_ids):
+    """
+    Deletes the posts whose IDs are in `post_ids` and their association rows,
+    with one statement per table, takes them off their users' post counts 
+    and records the deletions. The shared allergen profiles stay. Doesn't
+    commit. Returns the (post ID, user ID) of every post deleted, which
+    leaves out any that another transaction deleted first, and the number
+    of association rows deleted.
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return [], 0
+    # a write first, so the transaction holds SQLite's write lock and the
+    # owners read below can't be deleted by anyone else before it commits
+    associations = db.session.execute(
+        assoc_table.delete().where(assoc_table.c.post_id.in_(post_ids))
+    ).rowcount
+    deleted = [tuple(row) for row in db.session.execute(
+        db.select([Post.__table__.c.id, Post.__table__.c.user_id])
+        .where(Post.__table__.c.id.in_(post_ids))
+    )]
+    if deleted:
+        db.session.execute(Post.__table__.delete().where(Post.__table__.c.id.in_(post_ids)))
+        record_changes("deleted", deleted)
+        per_user = Counter(user_id for _, user_id in deleted if user_id is not None)
+        adjust_post_counts({user_id: -count for user_id, count in per_user.items()})
+    return deleted, associations
+
 
 class Location(db.Model):
     """
@@ -164,10 +267,10 @@ class Location(db.Model):
     __tablename__ = "locations"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     name = db.Column(db.String, nullable = False)
-    latitude = db.Column(db.Integer, nullable = False)
-    longitude = db.Column(db.Integer, nullable = False)
+    latitude = db.Column(db.Float, nullable = False)
+    longitude = db.Column(db.Float, nullable = False)
 
-    # posts = db.relationship("Post", back_populates="location", cascade="delete")
+    posts = db.relationship("Post", back_populates="location")
 
     def __init__(self, **kwargs):
         """
@@ -177,119 +280,160 @@ class Location(db.Model):
         self.latitude = kwargs.get("latitude")
         self.longitude = kwargs.get("longitude")
 
+    @serializer
     def serialize(self):
         """
         serialize location object
         """
-        return {
-            "id" : self.id,
-            "name" : self.name,
-            "latitude" : self.latitude,
-            "longitude" : self.longitude
-        }
+        return LOCATION(self)
+
+def decode_image_data(image_data):
+    """
+    Splits a base64 data URI into its file extension and decoded bytes.
+    Raises ValueError if the image is not a supported filetype or is not 
+    valid base64.
+    """
+    mime_type = guess_type(image_data)[0]
+    ext = guess_extension(mime_type)[1:] if mime_type else None
+
+    # only accept supported file extensions
+    if ext not in EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}")
+
+    # remove header of base64 string
+    img_str = re.sub("^data:image/.+;base64,", "", image_data)
+    try:
+        return ext, base64.b64decode(img_str, validate=True)
+    except binascii.Error:
+        raise ValueError("Invalid image data")
+
+
+def render_derivative(img, longest):
+    """
+    Re-encodes `img` scaled down to fit `longest` pixels on its longest side,
+    or at full size if `longest` is None, and returns it in a buffer
+    """
+    out = img.copy()
+    if longest is not None:
+        out.thumbnail((longest, longest))
+
+    buffer = BytesIO()
+    if img.format == "JPEG":
+        if out.mode not in ("RGB", "L"):
+            out = out.convert("RGB")
+        out.save(buffer, "JPEG", quality=85, optimize=True, progressive=True)
+    else:
+        out.save(buffer, img.format, optimize=True)
+    buffer.seek(0)
+    return buffer
+
 
 class Asset(db.Model):
     """
     Asset model
+
+    Assets are keyed by the SHA-256 of the image bytes, so uploading the same
+    image twice returns the existing asset. An asset is created "pending" and
+    becomes "ready" once a background worker has stored every size in
+    IMAGE_SIZES, or "failed" if that went wrong.
     """
     __tablename__ = "assets"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     base_url = db.Column(db.String, nullable=True)
-    salt = db.Column(db.String, nullable=False)
+    content_hash = db.Column(db.String, nullable=False, unique=True)
     extension = db.Column(db.String, nullable=False)
-    width = db.Column(db.Integer, nullable=False)
-    height = db.Column(db.Integer, nullable=False)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
 
     def __init__(self, **kwargs):
         """
-        Initializes an Asset object
+        Initializes a pending Asset object
+        """
+        self.content_hash = kwargs.get("content_hash")
+        self.extension = kwargs.get("extension")
+        self.status = ASSET_PENDING
+        self.created_at = datetime.datetime.now()
+
+    def key(self, size):
+        """
+        Storage key of the `size` derivative
+        """
+        return f"{self.content_hash}/{size}.{self.extension}"
+
+    def url(self, size="full"):
+        """
+        Public URL of the `size` derivative, or None until it has been uploaded
         """
-        self.create(kwargs.get("image_data"))
+        if self.base_url is None:
+            return None
+        return f"{self.base_url}/{self.key(size)}"
 
+    @serializer
     def serialize(self):
         """
         Serializes an Asset object
         """
         return {
-            "url" : self.url,
+            "id" : self.id,
+            "url" : self.url(),
+            "urls" : {size: self.url(size) for size in IMAGE_SIZES},
+            "status" : self.status,
+            "width" : self.width,
+            "height" : self.height,
             "created_at" : str(self.created_at)
         }
 
-    def create(self, image_data):
+    def process(self, image, storage):
         """
-        Given an image in base64 form, does the following:
-        1. Rejects the image if it is not a support filetype
-        2. Generates a random string for the image filename
-        3. Decodes the image and attempts to upload it to AWS
+        Decodes the image in the file object `image`, records its dimensions
+        and uploads every size in IMAGE_SIZES to `storage`, marking the asset
+        "ready", or "failed" if any step goes wrong
         """
         try:
-            ext = guess_extension(guess_type(image_data)[0])[1:]
-
-            # only accept supported file extensions
-            if ext not in EXTENSIONS:
-                raise Exception(f"Unsupported file type: {ext}")
-
-            # secure way of generating a random string for image filename
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits
-                ) 
-                for _ in range(16)
-            )
-
-            # remove header of base64 string
-            img_str = re.sub("^data:image/.+;base64,", "", image_data)
-            img_data = base64.b64decode(img_str)
-            img = Image.open(BytesIO(img_data))
-
-            self.base_url = S3_BASE_URL
-            self.salt = salt
-            self.extension = ext
+            image.seek(0, io.SEEK_END)
+            original_size = image.tell()
+            image.seek(0)
+            img = Image.open(image)
             self.width = img.width
             self.height = img.height
-            self.created_at = datetime.datetime.now()
+            content_type = Image.MIME.get(img.format)
 
-            img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
+            for size, longest in IMAGE_SIZES.items():
+                buffer = render_derivative(img, longest)
+                # keep the original when re-encoding doesn't make it smaller
+                if longest is None and buffer.getbuffer().nbytes >= original_size:
+                    image.seek(0)
+                    buffer = image
+                storage.put(self.key(size), buffer, content_type)
 
-            self.url = f"{self.base_url}/{self.salt}.{self.extension}"
+            self.base_url = storage.base_url
+            self.status = ASSET_READY
 
         except Exception as e:
-            print(f"Error when creating image: {e}")
-
-    def upload(self, img, img_filename):
-        """
-        Attempts to upload the image to the specified S3 bucket
-        """
-        try:
-            # save image temporarily on server
-            img_temploc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temploc)
+            print(f"Error when processing image: {e}")
+            self.status = ASSET_FAILED
 
-            # upload the image to S3
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temploc, S3_BUCKET_NAME, img_filename)
-
-            # make S3 image url is public
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL="public-read")
-
-            # remove image from server
-            os.remove(img_temploc)
+def allergen_mask(flags):
+    """
+    Returns the bitmask of the truthy flags in the `flags` dict, with bit i
+    standing for ALLERGEN_FLAGS[i]
+    """
+    return sum(1 << i for i, flag in enumerate(ALLERGEN_FLAGS) if flags.get(flag))
 
-        except Exception as e:
-            print(f"Error when uploading image: {e}")
 
 class Allergen(db.Model):
     """
     Allergen Model
 
-    Many-to-many with posts
+    Many-to-many with posts. Each row is an allergen profile, one of the 
+    2^9 combinations of the flags, created once by the migrations and 
+    shared by every post with that combination.
     """
     __tablename__ = "allergens"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    mask = db.Column(db.Integer, unique=True, index=True)
     vegan = db.Column(db.Boolean)
     vegetarian = db.Column(db.Boolean)
     gluten_free = db.Column(db.Boolean)
@@ -312,35 +456,69 @@ class Allergen(db.Model):
         self.shell_free = kwargs.get("shell_free", False)
         self.wheat_free = kwargs.get("wheat_free", False)
         self.soy_free = kwargs.get("soy_free", False)
+        self.mask = allergen_mask(kwargs)
 
+    @serializer
     def serialize(self):
-        return {
-            "id": self.id,
-            "vegan": self.vegan, 
-            "vegetarian": self.vegetarian, 
-            "gluten_free": self.gluten_free, 
-            "dairy_free": self.dairy_free, 
-            "nut_free": self.nut_free, 
-            "fish_free": self.fish_free, 
-            "shell_free": self.shell_free, 
-            "wheat_free": self.wheat_free,
-            "soy_free": self.soy_free
-            # "posts": 
-        }
+        return ALLERGEN_FULL(self)
 
+    @serializer
     def serialize_simp(self):
         """
         Simple serialize -- doesn't serialize posts
         """
-        return {
-            # "id": self.id,
-            "vegan": self.vegan, 
-            "vegetarian": self.vegetarian, 
-            "gluten_free": self.gluten_free, 
-            "dairy_free": self.dairy_free, 
-            "nut_free": self.nut_free, 
-            "fish_free": self.fish_free, 
-            "shell_free": self.shell_free, 
-            "wheat_free": self.wheat_free,
-            "soy_free": self.soy_free
-        }
\ No newline at end of file
+        return ALLERGEN_SIMP(self)
+
+
+class AllergenProfiles:
+    """
+    Process-local map from allergen mask to the ID of its Allergen row.
+    The rows never change, so it is loaded once and never invalidated.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        rows = db.session.query(Allergen.mask, Allergen.id).filter(Allergen.mask.isnot(None))
+        with self.lock:
+            self.ids = dict(rows)
+
+    def id_for(self, flags):
+        """
+        Returns the ID of the allergen profile for the flags dict `flags`
+        """
+        mask = allergen_mask(flags)
+        allergen_id = self.ids.get(mask)
+        if allergen_id is None:
+            self.load()
+            allergen_id = self.ids[mask]
+        return allergen_id
+
+
+allergen_profiles = AllergenProfiles()
+
+
+# compiled serializers behind the models' serialize methods; the field lists
+# define the JSON each endpoint returns
+ALLERGEN_SIMP = Serializer(Allergen, ALLERGEN_FLAGS)
+ALLERGEN_FULL = Serializer(Allergen, ["id"] + ALLERGEN_FLAGS)
+USER_SIMP = Serializer(User, ["id", "name"])
+LOCATION = Serializer(Location, ["id", "name", "latitude", "longitude"])
+POST_SIMP = Serializer(
+    Post,
+    ["id", "user_id", "building", "room", "allergens"],
+    nested={"allergens": ALLERGEN_SIMP}
+)
+POST_FULL = Serializer(
+    Post,
+    ["id", "user_id", "user", "building", "room", "location_id", 
+    ("descrption", "description"), "allergens"],
+    nested={"user": USER_SIMP, "allergens": ALLERGEN_SIMP}
+)
+USER_FULL = Serializer(
+    User,
+    ["id", "name", "post_count", ("posts", "live_posts")],
+    nested={"live_posts": POST_SIMP}
+)
+USER_SUMMARY = Serializer(User, ["id", "name", "post_count"])
@@ -0,0 +1,54 @@
+"""
+SQLite engine profile.
+
+Every connection is switched to write-ahead logging, so readers never block
+the writer and the writer never blocks readers, with synchronous=NORMAL,
+which in WAL mode only syncs at checkpoints and can't corrupt the database.
+The database is memory-mapped for reads, and a connection waits up to
+SQLITE_BUSY_TIMEOUT_MS for another process's write lock instead of failing
+with "database is locked" straight away.
+
+Connections are pooled per process (SQLITE_POOL_SIZE, plus up to
+SQLITE_POOL_OVERFLOW more under load) instead of being opened for every
+request, so the pragmas only run once per connection.
+"""
+import os
+import sqlite3
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_MMAP_BYTES = int(os.environ.get("SQLITE_MMAP_BYTES", 256 * 1024 * 1024))
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 8))
+SQLITE_POOL_OVERFLOW = int(os.environ.get("SQLITE_POOL_OVERFLOW", 16))
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with a connection pool for file-backed SQLite databases
+    """
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername == "sqlite" and sa_url.database not in (None, "", ":memory:"):
+            options["poolclass"] = QueuePool
+            options["pool_size"] = SQLITE_POOL_SIZE
+            options["max_overflow"] = SQLITE_POOL_OVERFLOW
+            # pooled connections are handed from thread to thread
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        return result
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA busy_timeout = %d" % SQLITE_BUSY_TIMEOUT_MS)
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA synchronous = %s" % SQLITE_SYNCHRONOUS)
+    cursor.execute("PRAGMA mmap_size = %d" % SQLITE_MMAP_BYTES)
+    cursor.close()
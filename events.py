@@ -0,0 +1,141 @@
+"""
+In-memory feed of post events for the server-sent events endpoint.
+
+The write handlers publish "created", "updated" and "deleted" events to a
+bounded log. Subscribers wait on a condition variable rather than polling,
+so an idle subscriber costs nothing but a parked generator. Under a
+threaded worker (gthread, the default in gunicorn.conf.py) each subscriber
+ties up a thread, so MAX_SUBSCRIBERS caps how many a process takes at once.
+Under a cooperative worker (the separate gevent stream server described in
+gunicorn.conf.py) each subscriber is a greenlet instead of an OS thread, so
+many idle clients can share one worker.
+
+Event IDs are "<epoch>-<sequence>", where the epoch changes every time the
+process starts. A client resuming from an ID that belongs to another epoch,
+or that has fallen out of the log, is sent a "reset" event and should
+refetch /api/posts/ before following the feed again.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+EVENT_LOG_SIZE = int(os.environ.get("EVENT_LOG_SIZE", 1000))
+KEEPALIVE_SECONDS = 15
+# 0 for no limit
+MAX_SUBSCRIBERS = int(os.environ.get("MAX_SUBSCRIBERS", 0))
+
+
+class EventLog:
+    """
+    Bounded log of the most recent `size` events
+    """
+    def __init__(self, size=EVENT_LOG_SIZE, max_subscribers=MAX_SUBSCRIBERS):
+        self.events = deque(maxlen=size)
+        self.epoch = uuid.uuid4().hex[:8]
+        self.last = 0
+        self.cond = threading.Condition()
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+
+    def reset(self):
+        """
+        Drops every event and starts a new epoch
+        """
+        with self.cond:
+            self.events.clear()
+            self.epoch = uuid.uuid4().hex[:8]
+            self.last = 0
+
+    def publish(self, kind, data):
+        with self.cond:
+            self.last += 1
+            self.events.append((self.last, kind, json.dumps(data)))
+            self.cond.notify_all()
+
+    def position(self, event_id):
+        """
+        Returns the sequence number in this log that `event_id` refers to, or
+        None if events after it can't be replayed
+        """
+        epoch, _, seq = (event_id or "").partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self.cond:
+            oldest = self.events[0][0] if self.events else self.last + 1
+            if seq > self.last or seq < oldest - 1:
+                return None
+        return seq
+
+    def wait(self, after, timeout):
+        """
+        Returns the events after sequence number `after`, waiting up to
+        `timeout` seconds for one if there are none yet
+        """
+        with self.cond:
+            if self.last <= after:
+                self.cond.wait(timeout)
+            return [event for event in self.events if event[0] > after]
+
+    def subscribe(self, last_event_id=None, keepalive=KEEPALIVE_SECONDS):
+        """
+        Returns the SSE stream for a client that last saw `last_event_id`,
+        or None if `max_subscribers` clients are subscribed already
+        """
+        with self.cond:
+            if self.max_subscribers and self.subscribers >= self.max_subscribers:
+                return None
+            self.subscribers += 1
+        return Subscription(self, self.stream(last_event_id, keepalive))
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def stream(self, last_event_id, keepalive):
+        yield "retry: 3000\n\n"
+        with self.cond:
+            after = self.last
+        if last_event_id:
+            seq = self.position(last_event_id)
+            if seq is None:
+                yield "id: %s-%d\nevent: reset\ndata: {}\n\n" % (self.epoch, after)
+            else:
+                after = seq
+
+        while True:
+            events = self.wait(after, keepalive)
+            if not events:
+                yield ": keepalive %d\n\n" % time.time()
+                continue
+            chunk = []
+            for seq, kind, data in events:
+                chunk.append("id: %s-%d\nevent: %s\ndata: %s\n\n" % (self.epoch, seq, kind, data))
+            after = events[-1][0]
+            yield "".join(chunk)
+
+
+class Subscription:
+    """
+    Response body of one subscriber, which gives up its place when the
+    server closes it, even if the client left before it started
+    """
+    def __init__(self, log, stream):
+        self.log = log
+        self.stream = stream
+        self.closed = False
+
+    def __iter__(self):
+        return self.stream
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stream.close()
+            self.log.unsubscribe()
+
+
+event_log = EventLog()
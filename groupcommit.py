@@ -0,0 +1,93 @@
+"""
+Group commit for small writes.
+
+With GROUP_COMMIT=1, write handlers hand their changes to a single writer
+thread per process instead of each committing a transaction of its own.
+The writer takes every write that queued up while it was busy (up to
+GROUP_COMMIT_MAX), waiting at most GROUP_COMMIT_WINDOW_MS for more to
+arrive, and commits them together: one fsync and one turn of SQLite's write
+lock for the whole group, so write throughput follows the request rate
+rather than the disk.
+
+If a group fails, it is rolled back and each write is retried in a
+transaction of its own, so only the failing write's caller sees the error.
+A write must therefore only stage changes in `db.session`, and must return
+plain values rather than model objects, which belong to the writer thread.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import db
+
+GROUP_COMMIT_MAX = int(os.environ.get("GROUP_COMMIT_MAX", 64))
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 2))
+
+
+class WriteQueue:
+    """
+    Queue of writes committed in groups of up to `max_group` by one thread
+    """
+    def __init__(self, max_group=GROUP_COMMIT_MAX, window_ms=GROUP_COMMIT_WINDOW_MS):
+        self.app = None
+        self.max_group = max_group
+        self.window = window_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        """
+        Starts the writer thread, if GROUP_COMMIT is on
+        """
+        if not self.app.config.get("GROUP_COMMIT") or self.running():
+            return
+        self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self.thread.start()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, write):
+        """
+        Runs `write()` on the writer thread and commits it with whatever else
+        is queued. Returns its result once committed, or raises its error.
+        """
+        future = Future()
+        self.queue.put((write, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            group = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_group:
+                try:
+                    group.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                self._commit(group)
+
+    def _commit(self, group):
+        try:
+            results = [write() for write, _ in group]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(group) == 1:
+                group[0][1].set_exception(e)
+            else:
+                for item in group:
+                    self._commit([item])
+            return
+
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+
+
+write_queue = WriteQueue()
@@ -0,0 +1,59 @@
+"""
+Gunicorn settings for production.
+
+The app is built once in the master, which migrates the database and builds
+the in-memory indexes, and the workers are forked from it. Each worker then
+opens its own database connections and starts its background threads in
+`post_fork`. Settings come from the environment:
+
+    PORT                   port to listen on (5000)
+    WEB_CONCURRENCY        worker processes (one per core)
+    GUNICORN_WORKER_CLASS  "gthread" (default), or "gevent" for the stream
+    GUNICORN_THREADS       threads per gthread worker (4)
+    GUNICORN_CONNECTIONS   concurrent connections per gevent worker (1000)
+
+Under gthread each /api/posts/stream/ subscriber holds one of the worker's
+threads for as long as it is connected, so at most GUNICORN_THREADS - 1 are
+let in per worker and the rest get 503. To serve many subscribers, run a
+second server with GUNICORN_WORKER_CLASS=gevent on the same database and
+route /api/posts/stream/ to it (see docker-compose.yml). There each
+subscriber is a greenlet, so idle ones only cost memory. Only the stream
+should go there: sqlite3 calls and image resizing block the whole gevent
+worker while they run, so everything else stays on gthread. Both servers
+must run with SYNC_CHANGES=1, so each follows the other's writes.
+"""
+import os
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class == "gevent":
+    # before the app is preloaded, so every lock it creates is cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+import multiprocessing
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 1000))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+preload_app = True
+
+# long-lived event streams would otherwise hold a keep-alive slot open
+keepalive = 5
+graceful_timeout = 30
+
+# workers share the database, so each must apply the others' writes to its
+# in-memory state (see changes.py); a gevent server always runs beside the
+# main one
+if workers > 1 or worker_class == "gevent":
+    os.environ.setdefault("SYNC_CHANGES", "1")
+
+# keep a thread free for other requests however many clients subscribe
+if worker_class == "gthread":
+    os.environ.setdefault("MAX_SUBSCRIBERS", str(max(1, threads - 1)))
+
+
+def post_fork(server, worker):
+    from app import init_worker
+
+    init_worker(server.app.wsgi())
@@ -0,0 +1,348 @@
+"""
+In-memory indexes over posts.
+
+The indexes are rebuilt from the database at startup and kept up to date by
+the write handlers in app.py after each commit.
+"""
+import datetime
+import heapq
+import math
+import re
+import threading
+
+from db import db, Post, Allergen, Location, ALLERGEN_FLAGS, assoc_table, unexpired
+
+NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# side of a grid cell in degrees, roughly 1.1 km north-south
+CELL_DEGREES = 0.01
+
+
+class Bitset:
+    """
+    Growable set of non-negative integers stored as one bit per member
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, n):
+        byte, bit = divmod(n, 8)
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte + 1 - len(self.data)))
+        self.data[byte] |= 1 << bit
+
+    def discard(self, n):
+        byte, bit = divmod(n, 8)
+        if byte < len(self.data):
+            self.data[byte] &= ~(1 << bit) & 0xFF
+
+    def __int__(self):
+        return int.from_bytes(self.data, "little")
+
+
+def members(bits):
+    """
+    Returns the members of the int bitset `bits` in ascending order
+    """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    found = []
+    for match in NONZERO_BYTE.finditer(data):
+        byte = match.start()
+        value = data[byte]
+        for bit in range(8):
+            if value >> bit & 1:
+                found.append(byte * 8 + bit)
+    return found
+
+
+class AllergenIndex:
+    """
+    Inverted index from each dietary flag to the bitset of post IDs that
+    carry it. A multi-flag filter is the AND of the flags' bitsets.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.posts = Bitset()
+        self.flags = {flag: Bitset() for flag in ALLERGEN_FLAGS}
+
+    def add(self, post_id, allergens):
+        """
+        Indexes post `post_id` under every flag that is truthy in the
+        `allergens` dict, replacing whatever was indexed for it before
+        """
+        with self.lock:
+            self.posts.add(post_id)
+            for flag, bits in self.flags.items():
+                if allergens.get(flag):
+                    bits.add(post_id)
+                else:
+                    bits.discard(post_id)
+
+    def remove(self, post_id):
+        with self.lock:
+            self.posts.discard(post_id)
+            for bits in self.flags.values():
+                bits.discard(post_id)
+
+    def bits(self, flags):
+        """
+        Returns the int bitset of posts that carry every flag in `flags`
+        """
+        with self.lock:
+            bits = int(self.posts)
+            for flag in flags:
+                bits &= int(self.flags[flag])
+        return bits
+
+    def match(self, flags):
+        """
+        Returns the IDs of all posts that carry every flag in `flags`
+        """
+        return members(self.bits(flags))
+
+    def rebuild(self):
+        """
+        Reloads the index from the database in a single query
+        """
+        columns = [getattr(Allergen, flag) for flag in ALLERGEN_FLAGS]
+        rows = db.session.query(Post.id, *columns) \
+            .outerjoin(assoc_table, assoc_table.c.post_id == Post.id) \
+            .outerjoin(Allergen, Allergen.id == assoc_table.c.allergen_id)
+        with self.lock:
+            self.clear()
+        for row in rows:
+            self.add(row[0], dict(zip(ALLERGEN_FLAGS, row[1:])))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Returns the great-circle distance in km between two points in degrees
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """
+    Spatial index that buckets posts into square grid cells of `cell` degrees
+    by the coordinates of their location. Nearest-neighbour queries scan the
+    cells in rings around the query point and stop as soon as no unscanned
+    cell can hold anything closer than what has been found. Posts that have
+    expired are passed over, so they don't take the place of live ones.
+    """
+    def __init__(self, cell=CELL_DEGREES):
+        self.cell = cell
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.cells = {}
+        self.points = {}
+
+    def key(self, lat, lng):
+        return (math.floor(lat / self.cell), math.floor(lng / self.cell))
+
+    def add(self, post_id, lat, lng, expires_at=None):
+        with self.lock:
+            self._discard(post_id)
+            key = self.key(lat, lng)
+            self.points[post_id] = (lat, lng, key, expires_at)
+            self.cells.setdefault(key, set()).add(post_id)
+
+    def remove(self, post_id):
+        with self.lock:
+            self._discard(post_id)
+
+    def _discard(self, post_id):
+        point = self.points.pop(post_id, None)
+        if point is not None:
+            bucket = self.cells[point[2]]
+            bucket.discard(post_id)
+            if not bucket:
+                del self.cells[point[2]]
+
+    def nearest(self, lat, lng, radius, k, accept=None):
+        """
+        Returns up to `k` (distance in km, post ID) pairs within `radius` km
+        of `lat`/`lng`, nearest first. Posts that have expired, and those for
+        which `accept(post_id)` is false, are skipped.
+        """
+        now = datetime.datetime.now()
+        # a cell step is narrowest east-west, at the edge of the search band
+        band = min(90.0, abs(lat) + radius / KM_PER_DEGREE + self.cell)
+        step = self.cell * KM_PER_DEGREE * max(math.cos(math.radians(band)), 1e-6)
+        max_ring = int(radius / step) + 1
+        row, col = self.key(lat, lng)
+
+        best = []
+
+        def consider(post_id):
+            p_lat, p_lng, _, expires_at = self.points[post_id]
+            # as `unexpired` would
+            if expires_at is None or expires_at <= now:
+                return
+            if accept is not None and not accept(post_id):
+                return
+            distance = haversine(lat, lng, p_lat, p_lng)
+            if distance > radius:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (-distance, -post_id))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, -post_id))
+
+        with self.lock:
+            if (2 * max_ring + 1) ** 2 > len(self.points):
+                # the rings would cover more cells than there are posts, as
+                # happens near the poles where cells get narrow, so checking
+                # every post is less work
+                for post_id in self.points:
+                    consider(post_id)
+            else:
+                for ring in range(max_ring + 1):
+                    # everything in this ring is at least ring - 1 steps away
+                    if len(best) == k and (ring - 1) * step > -best[0][0]:
+                        break
+                    for key in self._ring(row, col, ring):
+                        for post_id in self.cells.get(key, ()):
+                            consider(post_id)
+        return sorted((-d, -p) for d, p in best)
+
+    def _ring(self, row, col, ring):
+        if ring == 0:
+            yield (row, col)
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield (row - ring, c)
+            yield (row + ring, c)
+        for r in range(row - ring + 1, row + ring):
+            yield (r, col - ring)
+            yield (r, col + ring)
+
+    def rebuild(self):
+        """
+        Reloads the index from the database in a single query
+        """
+        rows = db.session.query(Post.id, Location.latitude, Location.longitude, Post.expires_at) \
+            .join(Location, Location.id == Post.location_id) \
+            .filter(unexpired())
+        with self.lock:
+            self.clear()
+        for post_id, lat, lng, expires_at in rows:
+            self.add(post_id, lat, lng, expires_at)
+
+
+class BuildingBoard:
+    """
+    Per-building counts of live posts and of the posts carrying each dietary
+    flag, adjusted as posts are added, changed and removed, so reading the
+    board takes time in the number of buildings rather than posts. Posts
+    are kept in a heap by expiry and dropped from the counts as soon as the
+    board is read after they expire, without waiting for the sweeper.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # post ID -> (building, flags it carries, when it expires)
+        self.posts = {}
+        # building -> [post count, then one count per ALLERGEN_FLAGS entry]
+        self.counts = {}
+        # (expires_at, post ID), including entries of posts since removed or
+        # re-added, which are skipped when they come up
+        self.expiry = []
+
+    def add(self, post_id, building, allergens, expires_at=None):
+        """
+        Counts post `post_id` under `building` and every flag that is truthy
+        in the `allergens` dict until `expires_at`, replacing whatever was 
+        counted for it before
+        """
+        flags = tuple(bool(allergens.get(flag)) for flag in ALLERGEN_FLAGS)
+        with self.lock:
+            self._discard(post_id)
+            self.posts[post_id] = (building, flags, expires_at)
+            counts = self.counts.setdefault(building, [0] * (len(ALLERGEN_FLAGS) + 1))
+            counts[0] += 1
+            for i, flag in enumerate(flags, 1):
+                counts[i] += flag
+            if expires_at is not None:
+                heapq.heappush(self.expiry, (expires_at, post_id))
+                if len(self.expiry) > 2 * len(self.posts) + 64:
+                    self._compact()
+
+    def remove(self, post_id):
+        with self.lock:
+            self._discard(post_id)
+
+    def _discard(self, post_id):
+        entry = self.posts.pop(post_id, None)
+        if entry is None:
+            return
+        building, flags, _ = entry
+        counts = self.counts[building]
+        counts[0] -= 1
+        if not counts[0]:
+            del self.counts[building]
+            return
+        for i, flag in enumerate(flags, 1):
+            counts[i] -= flag
+
+    def _compact(self):
+        self.expiry = [
+            (expires_at, post_id) for post_id, (_, _, expires_at) in self.posts.items()
+            if expires_at is not None
+        ]
+        heapq.heapify(self.expiry)
+
+    def _expire(self, now):
+        """
+        Drops the posts that expired by `now`, as `unexpired` would
+        """
+        while self.expiry and self.expiry[0][0] <= now:
+            expires_at, post_id = heapq.heappop(self.expiry)
+            entry = self.posts.get(post_id)
+            if entry is not None and entry[2] == expires_at:
+                self._discard(post_id)
+
+    def summary(self):
+        """
+        Returns each building with unexpired posts, in name order, with its
+        number of posts and how many of them carry each flag
+        """
+        with self.lock:
+            self._expire(datetime.datetime.now())
+            counts = sorted((building, list(c)) for building, c in self.counts.items())
+        return [{
+            "building": building,
+            "posts": c[0],
+            "allergens": dict(zip(ALLERGEN_FLAGS, c[1:])),
+        } for building, c in counts]
+
+    def rebuild(self):
+        """
+        Reloads the board from the unexpired posts in a single query
+        """
+        columns = [getattr(Allergen, flag) for flag in ALLERGEN_FLAGS]
+        rows = db.session.query(Post.id, Post.building, Post.expires_at, *columns) \
+            .outerjoin(assoc_table, assoc_table.c.post_id == Post.id) \
+            .outerjoin(Allergen, Allergen.id == assoc_table.c.allergen_id) \
+            .filter(unexpired())
+        with self.lock:
+            self.clear()
+        for row in rows:
+            self.add(row[0], row[1], dict(zip(ALLERGEN_FLAGS, row[3:])), row[2])
+
+
+allergen_index = AllergenIndex()
+grid_index = GridIndex()
+building_board = BuildingBoard()
@@ -0,0 +1,65 @@
+"""
+Background ingestion of uploaded images.
+
+Upload requests only validate the image header and store a pending Asset;
+decoding and uploading happen on a bounded pool of worker threads, which 
+close the image file they were handed once done.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from db import db, Asset
+from storage import get_storage
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 4))
+IMAGE_QUEUE_SIZE = int(os.environ.get("IMAGE_QUEUE_SIZE", 64))
+
+
+class ImageIngestor:
+    """
+    Pool of `workers` threads that process pending assets. At most
+    `workers + queue_size` images are in flight at once; past that `submit`
+    refuses new work so queued image data can't grow without bound.
+    """
+    def __init__(self, workers=IMAGE_WORKERS, queue_size=IMAGE_QUEUE_SIZE):
+        self.app = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def init_app(self, app):
+        self.app = app
+
+    def submit(self, asset_id, image):
+        """
+        Queues the image file object of the committed asset `asset_id` for
+        processing. Returns False if the queue is full, in which case the 
+        caller keeps ownership of `image`.
+        """
+        if not self.slots.acquire(blocking=False):
+            return False
+        try:
+            self.executor.submit(self._run, asset_id, image)
+        except Exception:
+            self.slots.release()
+            raise
+        return True
+
+    def _run(self, asset_id, image):
+        try:
+            with self.app.app_context():
+                asset = Asset.query.get(asset_id)
+                if asset is not None:
+                    asset.process(image, get_storage())
+                    db.session.commit()
+        except Exception as e:
+            print(f"Error when ingesting image {asset_id}: {e}")
+        finally:
+            image.close()
+            self.slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+ingestor = ImageIngestor()
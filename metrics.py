@@ -0,0 +1,198 @@
+"""
+Per-request metrics and the slow-query log.
+
+For every request this records, per route, the total latency, the number of
+SQL statements, the time spent in the database and the time spent
+serializing the response. They are kept as histograms and rendered in the
+Prometheus text format by `render`.
+
+Statements slower than SLOW_QUERY_MS milliseconds are logged to the
+"freeatery.slow_query" logger, sampled at SLOW_QUERY_SAMPLE (0 to 1).
+"""
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+SLOW_QUERY_SAMPLE = float(os.environ.get("SLOW_QUERY_SAMPLE", 1.0))
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+
+slow_query_log = logging.getLogger("freeatery.slow_query")
+
+
+class Histogram:
+    """
+    Cumulative histogram with one series per label set
+    """
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, (counts, total, count) in series:
+            labels = ",".join(
+                '%s="%s"' % (name, escape(value))
+                for name, value in zip(self.labels, label_values)
+            )
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, bucket_count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, labels, count))
+            lines.append("%s_sum{%s} %r" % (self.name, labels, total))
+            lines.append("%s_count{%s} %d" % (self.name, labels, count))
+        return "\n".join(lines)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "freeatery_request_duration_seconds", "Total request latency.",
+    ("method", "route", "status"), TIME_BUCKETS)
+DB_STATEMENTS = Histogram(
+    "freeatery_request_db_statements", "SQL statements executed per request.",
+    ("method", "route"), COUNT_BUCKETS)
+DB_SECONDS = Histogram(
+    "freeatery_request_db_seconds", "Time spent executing SQL per request.",
+    ("method", "route"), TIME_BUCKETS)
+SERIALIZE_SECONDS = Histogram(
+    "freeatery_request_serialize_seconds",
+    "Time spent serializing models and encoding JSON per request.",
+    ("method", "route"), TIME_BUCKETS)
+
+HISTOGRAMS = [REQUEST_SECONDS, DB_STATEMENTS, DB_SECONDS, SERIALIZE_SECONDS]
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.serializing = False
+
+
+def current():
+    """
+    Returns the stats of the request being handled, or None outside a request
+    """
+    if not has_request_context():
+        return None
+    return g.get("request_stats")
+
+
+def route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@contextmanager
+def serializing():
+    """
+    Counts the time spent in the block towards the request's serialization
+    time, less any database time incurred by lazy loads inside it. Nested
+    blocks are only counted once.
+    """
+    stats = current()
+    if stats is None or stats.serializing:
+        yield
+        return
+    stats.serializing = True
+    start = time.perf_counter()
+    db_before = stats.db_time
+    try:
+        yield
+    finally:
+        stats.serializing = False
+        stats.serialize_time += time.perf_counter() - start - (stats.db_time - db_before)
+
+
+def serializer(method):
+    """
+    Decorator that times a model's serialize method with `serializing`
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with serializing():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+    if elapsed * 1000 >= SLOW_QUERY_MS and random.random() < SLOW_QUERY_SAMPLE:
+        slow_query_log.warning(
+            "%.1fms %s %s params=%.200r",
+            elapsed * 1000, route() if stats is not None else "-", statement, parameters
+        )
+
+
+def init_app(app):
+    """
+    Starts recording metrics for every request handled by `app`
+    """
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = current()
+        if stats is not None:
+            labels = (request.method, route())
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - stats.start, *labels, str(response.status_code)
+            )
+            DB_STATEMENTS.observe(stats.statements, *labels)
+            DB_SECONDS.observe(stats.db_time, *labels)
+            SERIALIZE_SECONDS.observe(stats.serialize_time, *labels)
+        return response
+
+
+def render():
+    """
+    Returns every histogram in the Prometheus text exposition format
+    """
+    return "\n".join(h.render() for h in HISTOGRAMS) + "\n"
@@ -0,0 +1,206 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in the one-row `schema_version` table. On startup
+`migrate` applies, in order, every migration newer than the stored version
+and records the new version, all in one transaction. Migration 1 creates any
+missing tables from the models, so a new database ends up on the same schema
+as an upgraded one; every later migration must be safe to run against a
+schema that already has its change, since create_all will have built the
+tables from the current models.
+
+To change the schema, update the models and append a migration to
+MIGRATIONS that makes the same change to an existing database.
+"""
+import datetime
+
+from db import db, Asset, change_table, ALLERGEN_FLAGS, POST_TTL_MINUTES, ASSET_FAILED
+
+
+def add_column(conn, table, column, ddl):
+    """
+    Adds `column` to `table` with the column definition `ddl`, unless the
+    table already has it
+    """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % table)]
+    if column not in columns:
+        conn.execute('ALTER TABLE "%s" ADD COLUMN %s %s' % (table, column, ddl))
+
+
+def create_tables(conn):
+    db.Model.metadata.create_all(bind=conn)
+
+
+def add_hot_query_indexes(conn):
+    # posts tables from before locations were linked lack the column
+    add_column(conn, "posts", "location_id", "INTEGER REFERENCES locations (id)")
+    # the foreign keys behind every relationship load, and building lookups
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_posts_user_id ON posts (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_posts_location_id ON posts (location_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_posts_building ON posts (building)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_association_post_id ON association (post_id)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_association_allergen_id ON association (allergen_id)"
+    )
+
+
+def add_post_search(conn):
+    # full-text index over posts, kept in sync with the posts table by triggers
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5("
+        "description, building, room, content='posts', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN "
+        "INSERT INTO posts_fts (rowid, description, building, room) "
+        "VALUES (new.id, new.description, new.building, new.room); END"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN "
+        "INSERT INTO posts_fts (posts_fts, rowid, description, building, room) "
+        "VALUES ('delete', old.id, old.description, old.building, old.room); END"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_update "
+        "AFTER UPDATE OF description, building, room ON posts BEGIN "
+        "INSERT INTO posts_fts (posts_fts, rowid, description, building, room) "
+        "VALUES ('delete', old.id, old.description, old.building, old.room); "
+        "INSERT INTO posts_fts (rowid, description, building, room) "
+        "VALUES (new.id, new.description, new.building, new.room); END"
+    )
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+
+def add_post_expiry(conn):
+    add_column(conn, "posts", "expires_at", "DATETIME")
+    # posts from before expiry get the default lifetime from now
+    expires_at = datetime.datetime.now() + datetime.timedelta(minutes=POST_TTL_MINUTES)
+    conn.execute(
+        "UPDATE posts SET expires_at = ? WHERE expires_at IS NULL",
+        expires_at.strftime("%Y-%m-%d %H:%M:%S.%f")
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_posts_expires_at ON posts (expires_at)")
+
+
+def add_user_post_count(conn):
+    add_column(conn, "users", "post_count", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        "UPDATE users SET post_count = "
+        "(SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id)"
+    )
+
+
+def add_change_log(conn):
+    change_table.create(bind=conn, checkfirst=True)
+
+
+def intern_allergens(conn):
+    # one row per combination of flags, shared by every post that has it
+    add_column(conn, "allergens", "mask", "INTEGER")
+    conn.execute("UPDATE allergens SET mask = " + " + ".join(
+        "COALESCE(%s, 0) * %d" % (flag, 1 << i) for i, flag in enumerate(ALLERGEN_FLAGS)
+    ))
+
+    # point every association at the oldest profile with the same flags
+    conn.execute(
+        "UPDATE association SET allergen_id = ("
+        "SELECT MIN(canonical.id) FROM allergens AS profile "
+        "JOIN allergens AS canonical ON canonical.mask = profile.mask "
+        "WHERE profile.id = association.allergen_id) "
+        "WHERE allergen_id IN (SELECT id FROM allergens)"
+    )
+    conn.execute(
+        "DELETE FROM association WHERE rowid NOT IN "
+        "(SELECT MIN(rowid) FROM association GROUP BY post_id, allergen_id)"
+    )
+    conn.execute("DELETE FROM allergens WHERE id NOT IN (SELECT MIN(id) FROM allergens GROUP BY mask)")
+
+    existing = {mask for (mask,) in conn.execute("SELECT mask FROM allergens")}
+    missing = [mask for mask in range(1 << len(ALLERGEN_FLAGS)) if mask not in existing]
+    if missing:
+        conn.execute(
+            "INSERT INTO allergens (mask, %s) VALUES (?, %s)" % (
+                ", ".join(ALLERGEN_FLAGS), ", ".join("?" * len(ALLERGEN_FLAGS))),
+            [[mask] + [mask >> i & 1 for i in range(len(ALLERGEN_FLAGS))] for mask in missing]
+        )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_allergens_mask ON allergens (mask)")
+
+
+def rebuild_assets(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info("assets")')]
+    if "content_hash" in columns:
+        return
+    # SQLite can't drop NOT NULL from salt, width and height, so the table is
+    # rebuilt. The hashes of old images are unknown and their objects aren't
+    # under the content_hash/size keys, so they come over as "failed" assets
+    # keyed by their salt.
+    new_assets = Asset.__table__.tometadata(db.MetaData(), name="assets_new")
+    new_assets.create(bind=conn)
+    conn.execute(
+        "INSERT INTO assets_new (id, base_url, content_hash, extension, width, height, "
+        "status, created_at) SELECT id, NULL, 'legacy:' || COALESCE(salt, id), extension, "
+        "width, height, ?, created_at FROM assets",
+        ASSET_FAILED
+    )
+    conn.execute("DROP TABLE assets")
+    conn.execute("ALTER TABLE assets_new RENAME TO assets")
+
+
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_hot_query_indexes),
+    (3, add_post_search),
+    (4, add_post_expiry),
+    (5, add_user_post_count),
+    (6, add_change_log),
+    (7, intern_allergens),
+    (8, rebuild_assets),
+]
+
+
+def migrate(engine):
+    """
+    Brings the database behind `engine` up to the latest schema version.
+    Returns the list of versions that were applied.
+    """
+    with engine.connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        with conn.begin():
+            # a write first, so this transaction holds SQLite's write lock and
+            # another process starting up waits instead of migrating too
+            conn.execute(
+                "INSERT INTO schema_version (version) SELECT 0 "
+                "WHERE NOT EXISTS (SELECT 1 FROM schema_version)"
+            )
+            version = conn.execute("SELECT version FROM schema_version").scalar()
+
+            applied = []
+            for number, migration in MIGRATIONS:
+                if number > version:
+                    migration(conn)
+                    applied.append(number)
+            if applied:
+                conn.execute("UPDATE schema_version SET version = ?", applied[-1])
+    return applied
+
+
+def reset(engine):
+    """
+    Drops every table, index and trigger in the database. Development only.
+    """
+    with engine.connect() as conn:
+        conn.execute("PRAGMA foreign_keys = OFF")
+        # virtual tables first, since dropping one also drops its shadow tables
+        virtual = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL%'"
+        ).fetchall()
+        for (name,) in virtual:
+            conn.execute('DROP TABLE IF EXISTS "%s"' % name)
+
+        objects = conn.execute(
+            "SELECT type, name FROM sqlite_master "
+            "WHERE type IN ('table', 'view', 'trigger') AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        for kind, name in objects:
+            conn.execute('DROP %s IF EXISTS "%s"' % (kind.upper(), name))
@@ -0,0 +1,119 @@
+"""
+Compiled model serializers.
+
+A Serializer describes the dict a model is serialized to: an ordered list of
+fields, each either a column or a relationship rendered by a nested
+Serializer. For every distinct set of fields it generates and compiles one
+plain function that builds the dict with direct attribute access, so the
+per-row cost is a single function call. It also builds the matching loader
+options, so a query only fetches the columns and relationships the chosen
+fields need.
+"""
+import threading
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+
+class Serializer:
+    """
+    Serializer for `model`. `fields` lists output keys in order; a field is
+    either an attribute name or an (output key, attribute name) pair. Fields
+    that are relationships are rendered with the Serializer given for that
+    attribute in `nested`.
+    """
+    def __init__(self, model, fields, nested=None):
+        self.model = model
+        self.nested = nested or {}
+        self.fields = [(f, f) if isinstance(f, str) else tuple(f) for f in fields]
+        self.uselist = {
+            rel.key: rel.uselist for rel in inspect(model).relationships
+            if rel.key in self.nested
+        }
+
+        # clients may ask for a field by output key or by attribute name
+        self.lookup = {}
+        for field in self.fields:
+            self.lookup[field[0]] = field
+            self.lookup[field[1]] = field
+
+        self.compiled = {}
+        self.lock = threading.Lock()
+        self.serialize = self.compile(tuple(self.fields))
+
+    def __call__(self, obj):
+        return self.serialize(obj)
+
+    def compile(self, fields):
+        """
+        Returns the serialize function for `fields`, generating it on first use
+        """
+        fn = self.compiled.get(fields)
+        if fn is not None:
+            return fn
+
+        env = {}
+        items = []
+        for key, attr in fields:
+            if attr in self.nested:
+                env["_" + attr] = self.nested[attr].serialize
+                if self.uselist[attr]:
+                    items.append("%r: [_%s(x) for x in obj.%s]" % (key, attr, attr))
+                else:
+                    items.append("%r: None if obj.%s is None else _%s(obj.%s)" % (
+                        key, attr, attr, attr))
+            else:
+                items.append("%r: obj.%s" % (key, attr))
+        source = "def serialize(obj):\n    return {%s}\n" % ", ".join(items)
+        exec(compile(source, "<%s serializer>" % self.model.__name__, "exec"), env)
+
+        fn = env["serialize"]
+        with self.lock:
+            self.compiled[fields] = fn
+        return fn
+
+    def select(self, names):
+        """
+        Returns the fields for the requested `names` in serializer order.
+        Raises ValueError for names that are not fields.
+        """
+        wanted = set()
+        for name in names:
+            if name not in self.lookup:
+                raise ValueError("Unknown field: %s" % name)
+            wanted.add(self.lookup[name])
+        return tuple(field for field in self.fields if field in wanted)
+
+    def only(self, names):
+        """
+        Returns the serialize function and loader options for a sparse
+        fieldset of `names`
+        """
+        fields = self.select(names)
+        return self.compile(fields), self.options(fields)
+
+    def options(self, fields=None, path=None):
+        """
+        Returns loader options that load exactly the columns and
+        relationships `fields` need, relative to the loader `path` for a
+        nested serializer
+        """
+        fields = self.fields if fields is None else fields
+        columns = [getattr(self.model, attr) for _, attr in fields if attr not in self.nested]
+        if not columns:
+            mapper = inspect(self.model)
+            columns = [mapper.get_property_by_column(mapper.primary_key[0]).class_attribute]
+        options = [path.load_only(*columns) if path is not None else load_only(*columns)]
+
+        for _, attr in fields:
+            if attr in self.nested:
+                relationship = getattr(self.model, attr)
+                if path is None:
+                    loader = selectinload if self.uselist[attr] else joinedload
+                    loader = loader(relationship)
+                elif self.uselist[attr]:
+                    loader = path.selectinload(relationship)
+                else:
+                    loader = path.joinedload(relationship)
+                options.extend(self.nested[attr].options(None, loader))
+        return options
@@ -0,0 +1,82 @@
+"""
+Storage backends for uploaded images.
+
+Every backend has `put(key, fileobj, content_type)` to store an object and
+`url(key)` to build its public URL. The backend is picked with the
+STORAGE_BACKEND environment variable: "s3" (the default) or "local", which
+writes into STORAGE_DIR and is meant for development and tests.
+"""
+import os
+import shutil
+import threading
+
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
+
+
+class S3Storage:
+    """
+    Stores objects in an S3 bucket with a public-read ACL
+    """
+    def __init__(self, bucket=S3_BUCKET_NAME, base_url=S3_BASE_URL):
+        import boto3
+
+        self.bucket = bucket
+        self.base_url = base_url
+        # boto3 clients are thread-safe, so one is shared by every upload
+        self.client = boto3.client("s3")
+
+    def put(self, key, fileobj, content_type):
+        self.client.upload_fileobj(
+            fileobj, self.bucket, key,
+            ExtraArgs={"ACL": "public-read", "ContentType": content_type}
+        )
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+
+class LocalStorage:
+    """
+    Stores objects as files under `root`, served from `base_url`
+    """
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url
+
+    def put(self, key, fileobj, content_type):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    Returns the process-wide storage backend, creating it on first use
+    """
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if os.environ.get("STORAGE_BACKEND", "s3") == "local":
+                root = os.environ.get("STORAGE_DIR", os.path.join(os.getcwd(), "uploads"))
+                _storage = LocalStorage(root, os.environ.get("STORAGE_URL", "file://" + root))
+            else:
+                _storage = S3Storage()
+        return _storage
+
+
+def set_storage(storage):
+    """
+    Replaces the process-wide storage backend, e.g. with a LocalStorage in tests
+    """
+    global _storage
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,95 @@
+"""
+Background deletion of expired posts.
+
+Every SWEEP_INTERVAL seconds a daemon thread deletes the posts whose
+`expires_at` has passed, along with their association rows. It works 
+through them SWEEP_BATCH posts per transaction, found through
+the index on `expires_at`, so SQLite's write lock is only ever held for one
+small batch and requests can write in between.
+
+Reads already hide expired posts, but cached responses rendered before a post
+expired can show it until the sweep that deletes it, so SWEEP_INTERVAL bounds
+how stale they get. Setting it to 0 turns the sweeper off.
+"""
+import datetime
+import os
+import threading
+import time
+
+from db import db, Post, delete_posts
+
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", 30))
+SWEEP_BATCH = int(os.environ.get("SWEEP_BATCH", 200))
+# pause between batches, so waiting writers get the lock
+SWEEP_PAUSE = 0.05
+
+
+class PostSweeper:
+    """
+    Deletes expired posts in batches of `batch`, every `interval` seconds,
+    calling `on_deleted(post_id, user_id)` for each one it deleted after its
+    batch commits
+    """
+    def __init__(self, interval=SWEEP_INTERVAL, batch=SWEEP_BATCH):
+        self.app = None
+        self.on_deleted = None
+        self.interval = interval
+        self.batch = batch
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def init_app(self, app, on_deleted):
+        self.app = app
+        self.on_deleted = on_deleted
+
+    def start(self):
+        """
+        Starts the sweeper thread, unless it is running or turned off
+        """
+        if self.interval <= 0 or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="sweeper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error when sweeping expired posts: {e}")
+
+    def sweep(self, now=None):
+        """
+        Deletes every post that expired before `now` (default: the current
+        time). Returns the number of posts deleted.
+        """
+        now = now or datetime.datetime.now()
+        deleted = 0
+        with self.app.app_context():
+            while True:
+                expired = db.session.query(Post.id, Post.user_id).filter(
+                    Post.expires_at <= now
+                ).order_by(Post.expires_at).limit(self.batch).all()
+                if not expired:
+                    return deleted
+
+                # another process's sweeper may have deleted some of them
+                # since they were read
+                swept, _ = delete_posts(post_id for post_id, _ in expired)
+                db.session.commit()
+                for post_id, user_id in swept:
+                    self.on_deleted(post_id, user_id)
+                deleted += len(swept)
+
+                if len(expired) < self.batch:
+                    return deleted
+                time.sleep(SWEEP_PAUSE)
+
+
+sweeper = PostSweeper()
@@ -0,0 +1,60 @@
+"""
+Concurrent PATCHes of a post with the same If-Match: only the first may be
+written, the other must get 412 rather than overwrite it.
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SWEEP_INTERVAL", "0")
+
+import app as app_module
+from db import db, ALLERGEN_FLAGS
+
+
+def test_patch_with_same_if_match_is_not_lost(tmp_path, monkeypatch):
+    app = app_module.create_app(str(tmp_path / "free.db"), reset_db=True, sync_changes=False)
+    client = app.test_client()
+    client.post("/api/users/", data=json.dumps({"name": "u"}))
+    post = {flag: False for flag in ALLERGEN_FLAGS}
+    post.update(user_id=1, building="Gates", room="101", description="pizza")
+    post_id = json.loads(client.post("/api/posts/", data=json.dumps(post)).data)["id"]
+    etag = client.get("/api/posts/%d/" % post_id).headers["ETag"]
+
+    # widen the window between reading the post and writing it
+    post_changes = app_module.post_changes
+
+    def slow_post_changes(*args):
+        time.sleep(0.3)
+        return post_changes(*args)
+
+    monkeypatch.setattr(app_module, "post_changes", slow_post_changes)
+
+    responses = {}
+
+    def patch(room):
+        response = app.test_client().patch(
+            "/api/posts/%d/" % post_id, data=json.dumps({"room": room}), headers={"If-Match": etag}
+        )
+        responses[room] = response.status_code
+
+    threads = [threading.Thread(target=patch, args=(room,)) for room in ("201", "202")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(responses.values()) == [200, 412]
+    written = [room for room, code in responses.items() if code == 200]
+    room = json.loads(client.get("/api/posts/%d/" % post_id).data)["room"]
+    assert room == written[0]
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
@@ -0,0 +1,79 @@
+"""
+The list endpoints must run the same number of queries however many rows
+they return, i.e. related rows are loaded up front rather than one query
+per row.
+
+Both dataset sizes stay under STREAM_BATCH rows, so each listing is a single
+keyset batch.
+
+    python -m pytest tests
+"""
+import json
+import os
+import random
+import sys
+import threading
+
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SWEEP_INTERVAL", "0")
+
+import app as app_module
+import bench
+from db import db
+
+# (users, locations, posts)
+SIZES = [(5, 3, 20), (50, 10, 200)]
+
+ENDPOINTS = [
+    "/api/posts/",
+    "/api/users/",
+    "/api/posts/filter/?filter=vegan",
+]
+
+
+def query_counts(tmp_path, users, locations, posts):
+    """
+    Seeds a fresh database of the given size and returns how many
+    statements each of ENDPOINTS runs
+    """
+    tmp_path.mkdir()
+    app = app_module.create_app(str(tmp_path / "free.db"), reset_db=True, sync_changes=False)
+    bench.seed(app_module, app, random.Random(0), users, locations, posts)
+    client = app.test_client()
+
+    counts = {}
+    with app.app_context():
+        engine = db.engine
+    requests = threading.get_ident()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        # background threads of the app don't count
+        if threading.get_ident() == requests:
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        for path in ENDPOINTS:
+            del statements[:]
+            response = client.get(path)
+            assert response.status_code == 200, response.data[:200]
+            assert json.loads(response.data)["posts"]
+            counts[path] = len(statements)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    return counts
+
+
+def test_list_queries_do_not_grow_with_rows(tmp_path):
+    small = query_counts(tmp_path / "small", *SIZES[0])
+    large = query_counts(tmp_path / "large", *SIZES[1])
+    assert small == large
+    assert all(count > 0 for count in small.values())
+
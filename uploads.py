@@ -0,0 +1,142 @@
+"""
+Streaming image uploads.
+
+The body of an upload, either raw image bytes or the `image` file of a
+multipart form, is read in chunks into a spool that keeps up to
+SPOOL_MEMORY_BYTES in memory and the rest in a temporary file, hashing it
+as it goes. Uploads over MAX_IMAGE_BYTES are refused from their
+Content-Length before anything is read, or as soon as the spool grows past
+the cap when the length isn't known up front. The type is sniffed from the
+first bytes and the dimensions from the image header, so nothing is decoded
+in the request; the spool itself is handed to the ingestor and from there
+to the storage backend.
+"""
+import hashlib
+import os
+import tempfile
+
+from PIL import Image
+from werkzeug.formparser import parse_form_data
+
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+SPOOL_MEMORY_BYTES = 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
+
+# leading bytes of each supported image type
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"\xff\xd8\xff", "jpg"),
+]
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+class ImageSpool:
+    """
+    Write-once spooled file that hashes what is written to it and refuses
+    to grow past `limit` bytes
+    """
+    def __init__(self, limit=MAX_IMAGE_BYTES):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.limit = limit
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise UploadTooLarge()
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def content_hash(self):
+        return self.hash.hexdigest()
+
+    def sniff(self):
+        """
+        Returns the extension and (width, height) of the image, read from
+        its header only. Raises UnsupportedImage if it is not a supported
+        image.
+        """
+        self.file.seek(0)
+        header = self.file.read(16)
+        ext = next((ext for magic, ext in IMAGE_SIGNATURES if header.startswith(magic)), None)
+        if ext is None:
+            raise UnsupportedImage("Unsupported file type")
+        self.file.seek(0)
+        try:
+            # opening is lazy: only the header is parsed, nothing is decoded
+            size = Image.open(self.file).size
+        except Exception:
+            raise UnsupportedImage("Invalid image data")
+        self.file.seek(0)
+        return ext, size
+
+
+def receive_image(request, limit=MAX_IMAGE_BYTES):
+    """
+    Streams the image in `request` into an ImageSpool and returns it.
+    Raises UploadTooLarge or UnsupportedImage, or ValueError if there is
+    no image in the request.
+    """
+    multipart = request.mimetype == "multipart/form-data"
+    # leave a multipart body room for its boundaries and headers
+    if request.content_length is not None and \
+            request.content_length > limit + (UPLOAD_CHUNK if multipart else 0):
+        raise UploadTooLarge()
+
+    if multipart:
+        spools = []
+        image = None
+
+        def stream_factory(*args, **kwargs):
+            spool = ImageSpool(limit)
+            spools.append(spool)
+            return spool
+
+        try:
+            _, _, files = parse_form_data(request.environ, stream_factory=stream_factory)
+            image = files.get("image")
+            if image is None:
+                raise ValueError("Missing image")
+        finally:
+            for spool in spools:
+                if image is None or spool is not image.stream:
+                    spool.close()
+        spool = image.stream
+    else:
+        spool = ImageSpool(limit)
+        try:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+
+    if spool.size == 0:
+        spool.close()
+        raise ValueError("Missing image")
+    return spool
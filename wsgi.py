@@ -0,0 +1,11 @@
+"""
+WSGI entry point, e.g. for gunicorn:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Servers other than gunicorn must call `init_worker(app)` in every process
+that serves requests, after it forks.
+"""
+from app import create_app
+
+app = create_app()